@@ -81,6 +81,54 @@ static void binshr_func(
 }
 
 
+/* Aggregate XOR of equally long blobs: binxor_agg(x) = x1 ^ x2 ^ ... ^ xn.
+ * NULLs are skipped, the result of an empty aggregate is NULL. */
+#define BINXOR_AGG_MAX 64
+
+struct binxor_agg_ctx {
+    int len;
+    unsigned char acc[BINXOR_AGG_MAX];
+};
+
+static void binxor_agg_step(
+    sqlite3_context *context,
+    int argc,
+    sqlite3_value **argv
+){
+    struct binxor_agg_ctx *ctx;
+    assert(argc == 1);
+    if( sqlite3_value_type(argv[0])==SQLITE_NULL ) return;
+
+    ctx = (struct binxor_agg_ctx*)sqlite3_aggregate_context(context, sizeof(*ctx));
+    if (ctx==0) {
+        sqlite3_result_error_nomem(context);
+        return;
+    }
+
+    const unsigned char *a = (const unsigned char*)sqlite3_value_blob(argv[0]);
+    int a_len = sqlite3_value_bytes(argv[0]);
+
+    if (ctx->len == 0) {
+        if (a_len > BINXOR_AGG_MAX) {
+            sqlite3_result_error(context, "binxor_agg: blob too long", -1);
+            return;
+        }
+        ctx->len = a_len;
+    } else if (a_len != ctx->len) {
+        sqlite3_result_error(context, "binxor_agg: blobs of different lengths", -1);
+        return;
+    }
+    for (int i=0; i<a_len; i++) {
+        ctx->acc[i] ^= a[i];
+    }
+}
+
+static void binxor_agg_final(sqlite3_context *context){
+    struct binxor_agg_ctx *ctx;
+    ctx = (struct binxor_agg_ctx*)sqlite3_aggregate_context(context, 0);
+    if (ctx==0 || ctx->len==0) return;
+    sqlite3_result_blob(context, (char*)ctx->acc, ctx->len, SQLITE_TRANSIENT);
+}
 
 #ifdef _WIN32
 __declspec(dllexport)
@@ -95,5 +143,8 @@ int sqlite3_extension_init(
     (void)pzErrMsg;    /* Unused parameter */
     rc = sqlite3_create_function(db, "binxor", 2, SQLITE_UTF8, 0,
                                                              binxor_func, 0, 0);
+    if (rc != SQLITE_OK) return rc;
+    rc = sqlite3_create_function(db, "binxor_agg", 1, SQLITE_UTF8, 0,
+                                    0, binxor_agg_step, binxor_agg_final);
     return rc;
 }
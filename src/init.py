@@ -7,6 +7,7 @@ import butter.fhandle
 from utils import *
 from store import *
 from OpenSSL import crypto
+from clize.parameters import multi
 
 RSA_KEY_SIZE = 2048 # TODO make configurable
 
@@ -19,7 +20,74 @@ for _loc in _schema_dirs:
 else:
     raise RuntimeError("Unable to find 'schema.sql' in %r" % _schema_dirs)
 
-def main(dir, *, synctree=False, name:'n'=None):
+def clone_db(source, path):
+    """Copy a consistent snapshot of the database of the store `source` to `path`
+    using SQLite's online backup and return it opened."""
+    import apsw
+    conn = apsw.Connection(path)
+    with conn.backup('main', source.db.connection, 'main') as backup:
+        backup.step()
+    conn.close()
+    db = SqliteWrapper(path, wal=True)
+    if source.sync_mode in ('synctree', 'iblt'):
+        # Needed to rebuild the synctree or IBLT after pruning (see `adopt_clone`)
+        db.connection.enableloadextension(True)
+        db.connection.loadextension(str(FILOCO_LIBDIR / 'binxor.so'))
+    return db
+
+def adopt_clone(db, store_id, sync_mode, synctree_bits=None, scope=None):
+    """Turn a database copied by `clone_db` into the one of a new store with id `store_id`.
+
+    The source store becomes an ordinary remote store with a new index, index
+    0 is the new store. Local filesystem state and per-peer sync state are
+    dropped and all FOBs are marked as having new versions, so that
+    `mdapply.py` creates them. With a `scope`, syncables outside of it are
+    deleted (as if the new store got them by mdsync)."""
+    with db:
+        if scope is not None:
+            select_scope(db, scope)
+            for table in ('fcvs', 'flvs', 'fobs'):
+                db.execute('delete from %s where id in (select s.id from syncables s where s.insert_order not in'
+                           ' (select insert_order from temp.scope_syncables))' % table)
+            db.execute('delete from syncables where insert_order not in (select insert_order from temp.scope_syncables)')
+            if sync_mode == 'synctree':
+                SyncTree(db, synctree_bits).rebuild()
+            elif sync_mode == 'iblt':
+                SyncIBLT(db).rebuild()
+        new_idx = db.query_first('select max(idx) + 1 from stores', _assoc=False)[0]
+        db.execute('update stores set idx=? where idx=0', new_idx)
+        db.execute('update syncables set origin_idx=? where origin_idx=0', new_idx)
+        db.insert('stores', idx=0, id=store_id)
+        for table in ('links', 'srs', 'inodes'):
+            db.execute('delete from %s' % table)
+        db.execute('drop table if exists mdsync_resume')
+        now = time.time()
+        db.execute('update fobs set _has_inode=0, _new_flvs=0, _new_fcvs=0')
+        db.execute('update fobs set _new_flvs=? where id in (select fob from flvs)', now)
+        db.execute('update fobs set _new_fcvs=? where id in (select fob from fcvs)', now)
+    if scope is not None:
+        # Give the space of the pruned syncables back
+        db.execute('vacuum')
+
+def main(dir, *, sync_mode='serial', synctree=False, synctree_bits:int=4, name:'n'=None, clone=None,
+         scope:multi()):
+    """
+    :param sync_mode: how metadata are synchronized, one of: serial, synctree, iblt
+    :param synctree: same as --sync-mode=synctree
+    :param clone: start with a copy of the metadata of an existing local store (the sync
+        mode is taken from it), only those within --scope if given. Much faster than
+        syncing everything with mdsync.
+    :param scope: only replicate metadata of this subtree of the world (a path relative
+        to the store root, can be given several times). By default, everything is replicated.
+    """
+    if synctree: sync_mode = 'synctree'
+    if sync_mode not in SYNC_MODES:
+        raise ArgumentError("Unknown sync mode %r (choose from %s)" % (sync_mode, ', '.join(SYNC_MODES)))
+    if clone is not None:
+        source, sub = Store.find(clone)
+        if sub != Path(): raise ArgumentError("Only whole stores can be cloned (%s), not a subtree." % source.root_path)
+        sync_mode = source.sync_mode
+        synctree_bits = source.synctree_bits
     if dir: os.chdir(dir or '.')
     try: store, sub = Store.find()
     except StoreNotFound: pass
@@ -29,12 +97,23 @@ def main(dir, *, synctree=False, name:'n'=None):
         os.mkdir('.filoco.tmp')
         spurt('.filoco.tmp/version', "1")
         spurt('.filoco.tmp/type', "fs")
-        db = SqliteWrapper('.filoco.tmp/meta.sqlite', wal=True)
-        sync_mode = 'synctree' if synctree else 'serial'
         spurt('.filoco.tmp/sync_mode', sync_mode)
-        tpl = jinja2.Template(slurp(SCHEMA_FILE), line_statement_prefix='#')
-        schema = tpl.render(sync_mode=sync_mode)
-        db.execute(schema)
+        scope_text = ''.join( path + '\n' for path in scope )
+        if scope:
+            spurt('.filoco.tmp/scope', scope_text)
+        if clone is not None:
+            db = clone_db(source, '.filoco.tmp/meta.sqlite')
+            # A legacy synctree (without explicit bits) must stay one
+            if synctree_bits is not None:
+                spurt('.filoco.tmp/synctree_bits', str(synctree_bits))
+        else:
+            db = SqliteWrapper('.filoco.tmp/meta.sqlite', wal=True)
+            if sync_mode == 'synctree':
+                SyncTree(db, synctree_bits) # validate
+                spurt('.filoco.tmp/synctree_bits', str(synctree_bits))
+            tpl = jinja2.Template(slurp(SCHEMA_FILE), line_statement_prefix='#')
+            schema = tpl.render(sync_mode=sync_mode)
+            db.execute(schema)
 
         key = crypto.PKey()
         key.generate_key(crypto.TYPE_RSA, RSA_KEY_SIZE)
@@ -53,7 +132,10 @@ def main(dir, *, synctree=False, name:'n'=None):
         store_id = cert.digest('sha256').decode('ascii').replace(':','').lower()
         spurt('.filoco.tmp/store_id', store_id)
 
-        db.insert('stores', idx=0, id=store_id)
+        if clone is not None:
+            adopt_clone(db, store_id, sync_mode, synctree_bits, parse_scope(scope_text))
+        else:
+            db.insert('stores', idx=0, id=store_id)
 
         spurt('.filoco.tmp/store_cert', crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode('ascii'))
         with open('.filoco.tmp/store_key', 'wb') as file:
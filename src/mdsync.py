@@ -7,27 +7,214 @@ from utils import *
 from store import *
 import struct
 import cbor, json
+import heapq
+from operator import itemgetter
 import socket
-import multiprocessing
+import threading, queue
+from bisect import bisect_right
 
-init_debug(['synctree', 'sendobj'])
+init_debug(['synctree', 'iblt', 'sendobj'])
 
-PROTOCOL = 1
+PROTOCOL = 3
 
+class DiffRestart(Exception):
+    """The hello received with the first exchange of a diff changes how it has
+    to be computed (see `MDSync.exchange`)."""
+
+
+class ValueDictionary:
+    """Dictionary coding of repeated values in frames (see `MDSync.encode_frame`).
+
+    Both sides of a connection keep the same dictionary for each direction. A
+    value is sent as is the first time and gets the next free code, afterwards
+    only its code is sent. Codes are ints, values are strings or bytes."""
+    def __init__(self, max_size):
+        self.codes = {}
+        self.values = []
+        # The dictionary stops growing at this size, further values are sent as is
+        self.max_size = max_size
+
+    def add(self, value):
+        if value not in self.codes and len(self.values) < self.max_size:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+
+    def encode(self, value):
+        if value is None: return None
+        code = self.codes.get(value)
+        if code is not None: return code
+        self.add(value)
+        return value
+
+    def decode(self, value):
+        if value is None: return None
+        if isinstance(value, int): return self.values[value]
+        self.add(value)
+        return value
+
+
+def _set_future_result(fut, result):
+    if not fut.done(): fut.set_result(result)
+
+def _set_future_exception(fut, exc):
+    if not fut.done(): fut.set_exception(exc)
+
+class ObjectWriter(threading.Thread):
+    """A thread doing database writes for mdsync using its own connection to the store.
+
+    Work is passed as functions taking the thread's store through a bounded
+    queue, so receiving from the network and writing to SQLite overlap, but
+    we never buffer too much. A server shares one writer among all sessions,
+    which serializes their writes.
+
+    With `dedup`, the writer remembers the IDs of all objects it has written,
+    so that sessions with several peers can skip objects another peer has
+    already sent."""
+    def __init__(self, root_path, queue_size, dedup=False):
+        super().__init__(name='mdsync-writer', daemon=True)
+        self.root_path = root_path
+        self.queue = queue.Queue(queue_size)
+        self.seen = set() if dedup else None
+        self.start()
+
+    def new_objects(self, objs):
+        """Return `objs` without the ones already written (if de-duplicating)."""
+        if self.seen is None: return objs
+        return [ obj for obj in objs if obj['id'] not in self.seen ]
+
+    def mark_written(self, objs):
+        if self.seen is not None:
+            self.seen.update( obj['id'] for obj in objs )
+
+    def run(self):
+        store = None
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            func, fut, loop = item
+            try:
+                if store is None: store = Store(self.root_path)
+                with store.db:
+                    # Lock before reading, a read transaction cannot be upgraded
+                    # after another connection commits.
+                    store.db.lock_now()
+                    ret = func(store)
+            except BaseException as e:
+                loop.call_soon_threadsafe(_set_future_exception, fut, e)
+            else:
+                loop.call_soon_threadsafe(_set_future_result, fut, ret)
+
+    async def put(self, func):
+        """Queue `func(store)` to be run by the thread, waiting if the queue is full.
+
+        Return a future with its result."""
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        await loop.run_in_executor(None, self.queue.put, (func, fut, loop))
+        return fut
+
+    async def stop(self):
+        """Stop the thread after all queued work is done."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.queue.put, None)
+        await loop.run_in_executor(None, self.join)
+
+class ObjectPrefetcher(threading.Thread):
+    """A thread reading and encoding objects to send using its own connection to the store
+    (or the one given as `MDSync.prefetch_store`).
+
+    Encoded chunks (see `MDSync.iter_object_chunks`) are passed to the event
+    loop through a bounded queue."""
+    def __init__(self, mdsync, select):
+        super().__init__(name='mdsync-prefetch', daemon=True)
+        self.mdsync = mdsync
+        self.select = select
+        self.queue = queue.Queue(mdsync.DB_QUEUE_SIZE)
+        self.cancelled = False
+        self.start()
+
+    def run(self):
+        try:
+            store = self.mdsync.prefetch_store or Store(self.mdsync.store.root_path)
+            for chunk in self.mdsync.iter_object_chunks(store, self.select):
+                self._put(chunk)
+                if self.cancelled: return
+        except BaseException as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    async def get(self):
+        """Return the next chunk of encoded objects, None at the end."""
+        item = await asyncio.get_event_loop().run_in_executor(None, self.queue.get)
+        if isinstance(item, BaseException): raise item
+        return item
+
+    def cancel(self):
+        self.cancelled = True
 
 class MDSync(Protocol):
+    # Number of objects serialized and written at once
+    SEND_CHUNK = 1000
+    # Number of received objects applied at once
+    RECV_BATCH = 5000
+    # Number of chunks or batches buffered between the event loop and the database threads
+    DB_QUEUE_SIZE = 4
+    # Whether we keep state for resuming interrupted transfers (see `resume`)
+    RESUMABLE = False
+    # Whether `compute_diff` depends on the scope of the session
+    SCOPED_DIFF = False
+    RESUME_SCHEMA = [
+        # The diff (as returned by `compute_diff`, CBOR-encoded) of the last, possibly
+        # interrupted, transfer to a peer and the highest insert_order of the objects
+        # the peer confirmed to have committed
+        'create table if not exists mdsync_resume (peer text primary key, diff blob not null, acked integer not null)',
+    ]
+    # Version of the multi-object frame format (see `encode_frame`), 0 to disable frames
+    FRAMES = 1
+    DICT_MAX_SIZE = 1 << 18
+    # Data columns coded using the FOB ID dictionary
+    FOB_COLUMNS = ('fob', 'parent_fob')
+    # Live mode (see `live`): how often we look for new local syncables and after
+    # how long without other traffic we send a heartbeat, in seconds
+    LIVE_POLL = 0.1
+    HEARTBEAT = 5
+    # A live peer we have not heard from for this long is considered gone
+    LIVE_TIMEOUT = 3 * HEARTBEAT
+    # Delay before a live client reconnects after losing the connection
+    RECONNECT_DELAY = 5
+
     def __new__(cls, store, *a, **kw):
         if cls is MDSync:
             # Automatically create instance of the right subclass for store's sync mode
             if store.sync_mode == 'synctree':
                 return super().__new__(TreeMDSync)
+            elif store.sync_mode == 'iblt':
+                return super().__new__(IBLTMDSync)
             else:
                 return super().__new__(SerialMDSync)
         else:
             return super().__new__(cls)
 
-    def __init__(self, store, file):
-        super().__init__(file=file)
+    def __init__(self, store, file, compress=None, writer=None, prefetch_store=None, live=False, initiator=False):
+        """
+        :param initiator: whether we opened the connection (our compression
+            preference wins, see `Protocol.process_hello`)
+        :param writer: a shared ObjectWriter, by default each session starts its own
+        :param prefetch_store: a store for reading objects to send, by default each
+            session opens its own. It must not be used by anyone else in the meantime.
+        :param live: stay connected after the sync and push new objects (see `live`)
+            if the other side wants it too
+        """
+        super().__init__(file=file, compress=compress, initiator=initiator)
         self.store = store
         self.db = store.db
         self.store_id2idx = {}
@@ -35,80 +222,557 @@ class MDSync(Protocol):
         for store in list(self.db.query('select * from stores')):
             self.store_id2idx[store.id] = store.idx
             self.store_idx2id[store.idx] = store.id
+        self.send_dicts = { name: ValueDictionary(self.DICT_MAX_SIZE) for name in ('origin', 'fob') }
+        self.recv_dicts = { name: ValueDictionary(self.DICT_MAX_SIZE) for name in ('origin', 'fob') }
+        self.shared_writer = self.writer = writer
+        self.prefetch_store = prefetch_store
+        self.want_live = live
+        self.in_live = False
+        # Set from both hellos (see `process_hello`)
+        self.scope = None
+        # Received objects not committed yet and insert_order ranges of committed ones
+        self.receiving = 0
+        self.received_ranges = []
+        if self.RESUMABLE:
+            for stmt in self.RESUME_SCHEMA: self.db.execute(stmt)
 
-    async def send_by_syncable_row(self, row):
-        kind = row['kind']
-        tbl = Store.TYPE2TABLE[kind]
-        obj = self.db.query_first('select * from %s where id=?'%tbl, row['id'])
-        obj = {k:v for k,v in obj.items() if not k.startswith('_')} # underscored cols are internal
-        to_send = {'kind': kind, 'origin': self.store_idx2id[row['origin_idx']], 'data': obj, 'id': row['id']}
-        del obj['id']
-        if self.store.sync_mode == 'serial':
-            to_send['serial'] = row['serial']
-        #if D_SENDOBJ:
-        #    log.debug('sending object %s', json.dumps(to_send))
-        self.send_cbor(to_send)
-        await self.out_stream.drain()
+    def get_hello(self):
+        hello = super().get_hello()
+        hello.update(protocol=PROTOCOL, store_id=self.store.store_id, sync_mode=self.store.sync_mode,
+                     frames=self.FRAMES, scope=self.store.scope, live=self.want_live)
+        if self.RESUMABLE:
+            # Peers we have an interrupted transfer for
+            hello['resume'] = [ row[0] for row in self.db.query('select peer from mdsync_resume', _assoc=False) ]
+        return hello
 
-    def object_received(self, obj):
-        kw = dict(obj['data'])
-        if self.store.sync_mode == 'serial':
-            kw['serial'] = obj['serial']
-        kind = obj['kind']
-        with self.db.ensure_transaction():
-            if kind in ('flv', 'fcv'):
-                kw.update({'_is_head': 1})
-                self.db.update('fobs', 'id=?', kw['fob'], **{'_new_%ss'%kind: time.time()})
-                if kw['parent_vers']:
-                    for parent_ver in split_idlist(kw['parent_vers']):
-                        self.db.update(Store.TYPE2TABLE[kind], 'id=?', parent_ver, _is_head=0)
-            self.store.add_syncable(obj['id'], obj['kind'], origin=obj['origin'], **kw)
+    @property
+    def peer_id(self):
+        return self.remote_hello['store_id']
 
-    async def recv_objects(self):
+    @property
+    def live_enabled(self):
+        return self.want_live and self.did_hello and self.remote_hello.get('live', False)
+
+    @property
+    def use_frames(self):
+        return bool(self.FRAMES) and self.did_hello and self.remote_hello.get('frames') == self.FRAMES
+
+    def process_hello(self, remote_hello):
+        super().process_hello(remote_hello)
+        if remote_hello.get('protocol') != PROTOCOL:
+            raise ProtocolError("Unsupported protocol version %r (we speak %d)"
+                                    % (remote_hello.get('protocol'), PROTOCOL))
+        if remote_hello.get('sync_mode') != self.store.sync_mode:
+            raise ProtocolError("Sync mode mismatch (local %s, remote %s). All stores in a world"
+                                " must use the same sync mode." % (self.store.sync_mode, remote_hello.get('sync_mode')))
+        # Only what both sides want is exchanged (None means everything)
+        self.scope = intersect_scopes(self.store.scope, remote_hello.get('scope'))
+        if self.scope is not None: log.info("Syncing only %s", ', '.join(self.scope) or 'nothing')
+
+    async def exchange(self, send_objects, to_recv):
+        # The hello goes with the first exchange of the diff, not to cost
+        # a round trip of its own. If the diff started without something
+        # the hello tells, both sides come to the same conclusion here and
+        # start it again.
+        first = not self.did_hello
+        ret = await super().exchange(send_objects, to_recv)
+        if first and ((self.SCOPED_DIFF and self.scope is not None) or self.resume_wanted()):
+            raise DiffRestart
+        return ret
+
+    def resume_wanted(self):
+        """Whether either side has an interrupted transfer to the other one."""
+        return self.RESUMABLE and (self.peer_id in self.local_hello['resume']
+                                   or self.store.store_id in self.remote_hello.get('resume', []))
+
+    def stage_send_selection(self, db, query, *args):
+        """Select syncables to send with a query returning their insert_order.
+
+        The result is put into the temporary table `send_selection`, which is
+        used by `iter_object_chunks`."""
+        db.execute('create temp table if not exists send_selection (insert_order integer primary key)')
+        db.execute('delete from temp.send_selection')
+        db.execute('insert or ignore into temp.send_selection ' + query, *args)
+
+    def iter_kind(self, store, kind):
+        """Yield (insert_order, object) for selected syncables of one kind, in insertion order."""
+        serial = self.store.sync_mode == 'serial'
+        query = ('select s.insert_order, s.origin_idx{serial}, t.* from temp.send_selection x'
+                 ' join syncables s on s.insert_order=x.insert_order join {tbl} t on t.id=s.id'
+                 ' order by x.insert_order').format(serial=', s.serial' if serial else '', tbl=Store.TYPE2TABLE[kind])
+        for row in store.db.query(query):
+            insert_order = row.pop('insert_order')
+            to_send = {'kind': kind, 'origin': store.get_store_id(row.pop('origin_idx')), 'id': row.pop('id')}
+            if serial:
+                to_send['serial'] = row.pop('serial')
+            to_send['data'] = {k:v for k,v in row.items() if not k.startswith('_')} # underscored cols are internal
+            yield insert_order, to_send
+
+    def iter_object_chunks(self, store, select):
+        """Yield tuples (list of encoded messages, number of objects, last insert_order)
+        with the objects chosen by `select`.
+
+        Runs in the prefetch thread with its own `store`. `select(db)` must
+        fill `send_selection` (see `stage_send_selection`). Syncables outside
+        the scope of the session are never sent.
+        There is one streaming query per kind, their results are merged to
+        send objects in insertion order, so that the other side can recreate
+        them without violating foreign key constraints. The selection and
+        the objects are read in one read transaction, so they come from one
+        consistent snapshot. Only temporary tables are written here, resume
+        state is saved by the session (see `send_objects`)."""
+        db = store.db
+        with db.ensure_transaction():
+            select(db)
+            if self.scope is not None:
+                store.stage_scope(self.scope)
+                db.execute('delete from temp.send_selection'
+                           ' where insert_order not in (select insert_order from temp.scope_syncables)')
+            streams = [ self.iter_kind(store, kind) for kind in Store.TYPE2TABLE ]
+            chunk = []
+            for insert_order, to_send in heapq.merge(*streams, key=itemgetter(0)):
+                #if D_SENDOBJ:
+                #    log.debug('sending object %s', json.dumps(to_send))
+                chunk.append(to_send)
+                if len(chunk) >= self.SEND_CHUNK:
+                    yield self.encode_object_chunk(chunk), len(chunk), insert_order
+                    chunk = []
+            if chunk:
+                yield self.encode_object_chunk(chunk), len(chunk), insert_order
+
+    async def send_selected(self, select):
+        """Send the objects chosen by `select` (see `iter_object_chunks`).
+
+        Objects are read and encoded by a prefetch thread, while we write
+        them out here."""
+        prefetcher = ObjectPrefetcher(self, select)
+        try:
+            while True:
+                chunk = await prefetcher.get()
+                if chunk is None: break
+                messages, count, last_order = chunk
+                self.send_sized_many(messages)
+                self.sent_counts.append(self.sent_counts[-1] + count)
+                self.sent_orders.append(last_order)
+                await self.drain_if_needed()
+        finally:
+            prefetcher.cancel()
+            # The prefetch store may be reused once we return
+            await asyncio.get_event_loop().run_in_executor(None, prefetcher.join)
+
+    def encode_object_chunk(self, objs):
+        """Return a list of messages with objects: one frame if the other side supports it, one per object otherwise."""
+        if self.use_frames:
+            return [ cbor.dumps(self.encode_frame(objs)) ]
+        else:
+            return [ cbor.dumps(obj) for obj in objs ]
+
+    def encode_frame(self, objs):
+        """Encode objects into one frame with a column for each field.
+
+        Objects of all kinds are mixed in one frame (that is how they come in
+        insertion order), data columns are kept separately for each kind:
+
+            {'kinds': [kind, ...], 'kind': [index into kinds, ...],
+             'id': [...], 'origin': [...], 'serial': [...] (serial mode only),
+             'data': {kind: {column: [values of objects of that kind]}}}
+
+        Origin store IDs and FOB IDs are coded using per-session dictionaries
+        (see ValueDictionary). Values are processed object by object, in
+        order: origin, data columns sorted by name, and finally the ID of
+        a FOB is added to the FOB dictionary without being sent as a code.
+        `decode_frame` must do the same."""
+        serial = self.store.sync_mode == 'serial'
+        kinds = sorted({ obj['kind'] for obj in objs })
+        kind_idx = { kind: i for i, kind in enumerate(kinds) }
+        frame = {'kinds': kinds, 'kind': [], 'id': [], 'origin': [], 'data': {}}
+        if serial: frame['serial'] = []
+        origins = self.send_dicts['origin']
+        fobs = self.send_dicts['fob']
+        for obj in objs:
+            kind = obj['kind']
+            frame['kind'].append(kind_idx[kind])
+            frame['id'].append(obj['id'])
+            frame['origin'].append(origins.encode(obj['origin']))
+            if serial: frame['serial'].append(obj['serial'])
+            data = obj['data']
+            columns = frame['data'].setdefault(kind, {})
+            if columns and columns.keys() != data.keys():
+                raise ValueError("Objects of kind %s with different columns in one frame" % kind)
+            for col in sorted(data):
+                value = fobs.encode(data[col]) if col in self.FOB_COLUMNS else data[col]
+                columns.setdefault(col, []).append(value)
+            if kind == 'fob': fobs.add(obj['id'])
+        return frame
+
+    def decode_frame(self, frame):
+        """Decode a frame made by `encode_frame` into a list of objects."""
+        kinds = frame['kinds']
+        serials = frame.get('serial')
+        origins = self.recv_dicts['origin']
+        fobs = self.recv_dicts['fob']
+        columns = { kind: [ (col, iter(values)) for col, values in sorted(cols.items()) ]
+                        for kind, cols in frame['data'].items() }
+        objs = []
+        for i, (kind_idx, id) in enumerate(zip(frame['kind'], frame['id'])):
+            kind = kinds[kind_idx]
+            obj = {'kind': kind, 'id': id, 'origin': origins.decode(frame['origin'][i])}
+            if serials is not None: obj['serial'] = serials[i]
+            data = obj['data'] = {}
+            for col, values in columns[kind]:
+                value = next(values)
+                data[col] = fobs.decode(value) if col in self.FOB_COLUMNS else value
+            if kind == 'fob': fobs.add(id)
+            objs.append(obj)
+        return objs
+
+    def stage_send_ids(self, db, ids):
+        """Put IDs of objects to send into the temporary table `send_ids`."""
+        db.execute('create temp table if not exists send_ids (id blob primary key)')
+        db.execute('delete from temp.send_ids')
+        db.executemany('insert or ignore into temp.send_ids values (?)', ( (oid,) for oid in ids ))
+
+    def objects_received(self, store, objs):
+        """Apply a batch of received objects to `store` in one transaction.
+
+        Runs in the writer thread, see ObjectWriter.
+
+        New objects are added by `Store.add_syncables`. Afterwards, parent
+        versions of new FLVs and FCVs lose their head flag and their FOBs are
+        stamped as having new versions, each with one `executemany` per kind.
+        This happens after all inserts, so parents and FOBs from the same
+        batch are handled too. Return the (inclusive) range of insert_orders
+        the new objects got, the writer holds the write lock, so nothing else
+        gets any of them."""
+        now = time.time()
+        db = store.db
+        max_order = 'select coalesce(max(insert_order), 0) from syncables'
+        with db.bulk_transaction():
+            first = db.query_first(max_order, _assoc=False)[0] + 1
+            for obj in objs:
+                if obj['kind'] in ('flv', 'fcv'):
+                    obj['data']['_is_head'] = 1
+            added = store.add_syncables(objs)
+            for kind in ('flv', 'fcv'):
+                new = [ obj['data'] for obj in added if obj['kind'] == kind ]
+                if not new: continue
+                parents = [ (parent_ver,) for data in new if data['parent_vers']
+                                for parent_ver in split_idlist(data['parent_vers']) ]
+                db.executemany('update %s set _is_head=0 where id=?' % Store.TYPE2TABLE[kind], parents)
+                fobs = OrderedDict.fromkeys( data['fob'] for data in new )
+                db.executemany('update fobs set _new_%ss=? where id=?' % kind, ( (now, fob) for fob in fobs ))
+            return first, db.query_first(max_order, _assoc=False)[0]
+
+    # The object stream
+    # -----------------
+    #
+    # Each side sends its objects (as frames or one by one) followed by an
+    # {'end': True} message. Interleaved with that, it acknowledges objects
+    # received from the other side with {'ack': n} once the first n of them
+    # are committed. After the final ack, the stream is terminated by an
+    # empty message. Acks let the sender keep track of what it does not need
+    # to send again if the transfer is interrupted (see `resume`).
+
+    def send_ack(self, count):
+        self.send_cbor({'ack': count})
+
+    async def peer_acked(self, count):
+        """The other side committed the first `count` objects we have sent."""
+        self.peer_ack_count = count
+        # Live pushes are not resumable, the next session does a new diff
+        if not self.RESUMABLE or self.in_live: return
+        # We only know the insert_order of the last object of each chunk
+        order = self.sent_orders[bisect_right(self.sent_counts, count) - 1]
+        if order <= self.peer_acked_order: return
+        self.peer_acked_order = order
+        def save(store):
+            store.db.execute('update mdsync_resume set acked=max(acked, ?) where peer=?', order, self.peer_id)
+        if self.writer is not None:
+            self.write_results.append(await self.writer.put(save))
+        else:
+            save(self.store)
+
+    async def recv_stream_message(self):
+        """Return the next message of the object stream other than an ack, None at the end."""
         while True:
-            # XXX this transacton affects the concurrent send task! is it a problem?
-            with self.db.ensure_transaction():
-                for i in range(5000):
-                    data = await self.recv_sized()
-                    if not data: break
-                    obj = cbor.loads(data)
-                    self.object_received(obj)
-            if not data: break
-
-    async def exchange_objects(self, to_send):
-        send_task = asyncio.ensure_future(self.send_objects(to_send))
+            data = await self.recv_sized()
+            if not data: return None
+            msg = cbor.loads(data)
+            if 'ack' in msg:
+                await self.peer_acked(msg['ack'])
+            else:
+                return msg
+
+    def check_write_results(self):
+        """Raise the first error from writes done so far."""
+        for fut in self.write_results:
+            if fut.done(): fut.result()
+        self.write_results = [ fut for fut in self.write_results if not fut.done() ]
+
+    async def write_received(self, writer, objs, received):
+        """Queue received objects for writing, acknowledge them as received
+        objects up to the `received`-th once committed."""
+        objs = writer.new_objects(objs)
+        def written(fut):
+            self.receiving -= 1
+            if fut.cancelled() or fut.exception() is not None: return
+            writer.mark_written(objs)
+            self.received_ranges.append(fut.result())
+            self.send_ack(received)
+        self.receiving += 1
+        try:
+            fut = await writer.put(partial(self.objects_received, objs=objs))
+        except BaseException:
+            self.receiving -= 1
+            raise
+        fut.add_done_callback(written)
+        self.write_results.append(fut)
+        self.check_write_results()
+
+    async def recv_objects(self):
+        received = 0
+        if self.shared_writer is None:
+            self.writer = ObjectWriter(self.store.root_path, self.DB_QUEUE_SIZE)
+        writer = self.writer
+        try:
+            end = False
+            while not end:
+                objs = []
+                while len(objs) < self.RECV_BATCH:
+                    msg = await self.recv_stream_message()
+                    if msg is None:
+                        raise ProtocolError("Object stream ended prematurely")
+                    if 'end' in msg:
+                        end = True
+                        break
+                    if self.use_frames:
+                        objs += self.decode_frame(msg)
+                    else:
+                        objs.append(msg)
+                if objs:
+                    received += len(objs)
+                    await self.write_received(writer, objs, received)
+            for fut in self.write_results: await fut
+        finally:
+            if writer is not self.shared_writer:
+                self.writer = None
+                await writer.stop()
+        self.send_ack(received)
+
+    async def send_objects_and_end(self, send):
+        await send
+        self.send_cbor({'end': True})
+        await self.out_stream.drain()
+
+    async def exchange_objects(self, to_send, resumed=False):
+        self.sent_counts = [0]
+        self.sent_orders = [0]
+        self.peer_ack_count = 0
+        self.peer_acked_order = 0
+        self.write_results = []
+        send = self.send_resumed() if resumed else self.send_objects(to_send)
+        send_task = asyncio.ensure_future(self.send_objects_and_end(send))
         recv_task = asyncio.ensure_future(self.recv_objects())
         done, pending = await asyncio.wait([send_task, recv_task],
                                 return_when=asyncio.FIRST_EXCEPTION)
-        return [ x.result() for x in done ]
+        for fut in pending: fut.cancel()
+        # Let them clean up (stop their threads) before we return
+        if pending: await asyncio.wait(pending)
+        for fut in done: fut.result()
+        # All our objects and acks are sent. The other side sends its final acks before terminating.
+        self.send_sized(b'')
+        await self.out_stream.drain()
+        if await self.recv_stream_message() is not None:
+            raise ProtocolError("Unexpected message after end of object stream")
+        for fut in self.write_results: await fut
+        if self.RESUMABLE and self.peer_ack_count == self.sent_counts[-1]:
+            # Transfer complete, nothing to resume
+            await self.write_state(lambda store: store.db.execute('delete from mdsync_resume where peer=?', self.peer_id))
+        log.info('Sent %d objects, %d acknowledged', self.sent_counts[-1], self.peer_ack_count)
+
+    async def resume(self):
+        """Finish transfers interrupted in previous sessions with the other side.
 
-    async def run(self):
+        The hellos list peers with interrupted transfers. If there is one in
+        either direction, both sides do an object exchange in which each sends
+        the objects selected last time and not acknowledged yet (or nothing).
+        The normal diff still runs afterwards, but it finds only what changed
+        since and acknowledged objects are not sent again."""
+        if self.resume_wanted():
+            log.info('Resuming interrupted transfer')
+            await self.exchange_objects(None, resumed=True)
+
+    async def send_resumed(self):
+        state = self.db.query_first('select diff, acked from mdsync_resume where peer=?', self.peer_id)
+        if state is None: return
+        diff = cbor.loads(state.diff)
+        def select(db):
+            self.select_diff(db, diff)
+            # Objects are sent in insertion order, the peer has all of them up to the acked one
+            db.execute('delete from temp.send_selection where insert_order <= ?', state.acked)
+        await self.send_selected(select)
+
+    async def write_state(self, func):
+        """Run `func(store)` writing sync state in the writer thread if there is one,
+        otherwise on our connection."""
+        if self.writer is not None:
+            await (await self.writer.put(func))
+        else:
+            with self.db: func(self.store)
+
+    def select_diff(self, db, diff):
+        """Select the objects to send for a `diff` returned by `compute_diff` (see `stage_send_selection`)."""
+        raise NotImplementedError
+
+    async def send_objects(self, diff):
+        if self.RESUMABLE:
+            # Only the diff is saved, not the selection, which is expensive for
+            # big transfers. The selection is recomputed from it on resume.
+            encoded = cbor.dumps(diff)
+            await self.write_state(lambda store: store.db.execute(
+                'insert or replace into mdsync_resume values (?, ?, 0)', self.peer_id, encoded))
+        await self.send_selected(partial(self.select_diff, diff=diff))
+
+    def max_insert_order(self):
+        return self.db.query_first('select coalesce(max(insert_order), 0) from syncables', _assoc=False)[0]
+
+    async def run(self, barrier=None):
         await self.prepare()
-        to_send = await self.compute_diff()
-        #with self.db.ensure_transaction():
-        if 1:
-            await self.exchange_objects(to_send)
+        while True:
+            # Everything added later is pushed in live mode (if the diff already
+            # sent some of it, the other side ignores the duplicates)
+            live_since = self.max_insert_order()
+            try:
+                to_send = await self.compute_diff()
+                break
+            except DiffRestart:
+                await self.resume()
+        # Lets a fan-out finish all diffs before writing anything (see MDSyncFanOut)
+        if barrier is not None: await barrier()
+        await self.exchange_objects(to_send)
+        if self.live_enabled:
+            await self.live(live_since)
+        await self.shutdown()
+
+    # Live mode
+    # ---------
+    #
+    # After the normal sync, both sides keep the connection open and continue
+    # the object stream without an end: new local syncables are sent as they
+    # are committed (by the scanner, mdapply or another sync) and acknowledged
+    # as usual. Objects received from the other side are not sent back. A
+    # side with nothing to send sends {'ping': True} every HEARTBEAT seconds,
+    # so that a dead connection is detected. After losing the connection,
+    # peers have to reconnect, which does a full diff again.
+
+    async def live(self, since):
+        """Push syncables added after insert_order `since` and all further ones
+        until the connection is closed."""
+        log.info('Sync done, pushing changes live')
+        self.in_live = True
+        self.sent_counts = [0]
+        self.sent_orders = [0]
+        self.write_results = []
+        if self.shared_writer is None:
+            self.writer = ObjectWriter(self.store.root_path, self.DB_QUEUE_SIZE)
+        writer = self.writer
+        tasks = [ asyncio.ensure_future(self.live_send(since)), asyncio.ensure_future(self.live_recv(writer)) ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done: fut.result()
+            # The other side has ended the stream, end ours too
+            self.send_sized(b'')
+            await self.out_stream.drain()
+        finally:
+            for fut in tasks: fut.cancel()
+            await asyncio.wait(tasks)
+            if writer is not self.shared_writer:
+                self.writer = None
+                await writer.stop()
+        log.info('Live sync ended by the other side')
+
+    async def live_send(self, last):
+        version = None
+        idle_since = time.monotonic()
+        while True:
+            await asyncio.sleep(self.LIVE_POLL)
+            # Wait until we know where received objects are, not to send them back
+            if not self.receiving and self.db.data_version() != version:
+                version = self.db.data_version()
+                newest = self.max_insert_order()
+                if newest > last:
+                    skip = [ (first, end) for first, end in self.received_ranges if end > last ]
+                    self.received_ranges = skip
+                    cond = ''.join( ' and insert_order not between %d and %d' % r for r in skip )
+                    self.sent_counts = self.sent_counts[-1:]
+                    self.sent_orders = self.sent_orders[-1:]
+                    await self.send_selected(lambda db, first=last + 1, end=newest: self.stage_send_selection(db,
+                            'select insert_order from syncables where insert_order between ? and ?' + cond,
+                            first, end))
+                    await self.out_stream.drain()
+                    if self.sent_counts[-1] != self.sent_counts[0]:
+                        if D_SENDOBJ: log.debug('Pushed %d objects', self.sent_counts[-1] - self.sent_counts[0])
+                        idle_since = time.monotonic()
+                    last = newest
+            if time.monotonic() - idle_since >= self.HEARTBEAT:
+                self.send_cbor({'ping': True})
+                await self.out_stream.drain()
+                idle_since = time.monotonic()
+
+    async def live_recv(self, writer):
+        received = 0
+        while True:
+            try:
+                msg = await asyncio.wait_for(self.recv_stream_message(), self.LIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise ProtocolError("No message from the other side for %d s" % self.LIVE_TIMEOUT)
+            except asyncio.IncompleteReadError:
+                raise ConnectionResetError("Connection closed by the other side")
+            if msg is None: return
+            if 'ping' in msg: continue
+            objs = self.decode_frame(msg) if self.use_frames else [msg]
+            received += len(objs)
+            await self.write_received(writer, objs, received)
 
 class TreeMDSync(MDSync):
-    # TODO: make parameters configurable per-world (all stores in a world must
-    # have same configuration)
+    RESUMABLE = True
+    SCOPED_DIFF = True
     # Start at some reasonable level so as not to send only a few bytes in the
-    # first exchange. For level 4, we have 16 nodes with 4+16+16 (pos+xor+chxor)
-    # = 36 bytes per node, which gives 16*36 = 576 bytes for the first exchnage.
-    # This seems reasonable cost even when there are no changes at all and it
-    # saves 4 roundtrips in the common case of several changes.
-    START_LVL = 4
+    # first exchange. We start at the first level with at least 2**START_BITS
+    # nodes. With 16 nodes and 8+16+16 (pos+xor+chxor) = 40 bytes per node, this
+    # gives 16*40 = 640 bytes for the first exchnage. This seems reasonable cost
+    # even when there are no changes at all and it saves 4 roundtrips (with
+    # a binary tree) in the common case of several changes.
+    START_BITS = 4
     NODE_FMT = '>Q16s16s' # a 64b position and two 128b xors
     NODE_BYTES = struct.calcsize(NODE_FMT)
-    def __init__(self, store, file):
-        super().__init__(store=store, file=file)
+    DEPTH_FMT = '>B'
+    DEPTH_BYTES = struct.calcsize(DEPTH_FMT)
+    # Speculative multi-level descent (see `choose_descent`)
+    DESCENT = True
+    # Assumed link bandwidth (bytes/s) until we measure one
+    DESCENT_BANDWIDTH = 1 << 20
+    # Weight of one exchange in the smoothed bandwidth estimate
+    DESCENT_GAIN = 0.25
+    def __init__(self, store, file, **kw):
+        super().__init__(store=store, file=file, **kw)
         self.synctree = store.synctree
 
+    def get_hello(self):
+        hello = super().get_hello()
+        hello['synctree'] = self.synctree.layout
+        hello['descent'] = self.DESCENT
+        return hello
+
+    def process_hello(self, remote_hello):
+        super().process_hello(remote_hello)
+        if remote_hello.get('synctree') != self.synctree.layout:
+            raise ProtocolError("Synctree layout mismatch (local %r, remote %r). All stores in a world must"
+                                " use the same synctree arity, see `synctree.py set-bits`."
+                                % (self.synctree.layout, remote_hello.get('synctree')))
+
     def get_xors(self, positions):
-        # TODO: is this better than several queries that can be precompiled?
-        ret = self.db.query('select pos, xor, chxor from synctree where pos in (%s)'
-                                   % ','.join(repeat('?', len(positions))), *positions)
-        return { row['pos'] : (row['xor'], row['chxor']) for row in ret }
+        return self.synctree.get_xors(positions)
 
     def send_level(self, level):
         """Transfer all the active vertices from one level of the synctree.
@@ -120,95 +784,324 @@ class TreeMDSync(MDSync):
 
     async def recv_level(self):
         if self.recv_tree_eof: return {}
-        ret = {}
         data = await self.recv_sized()
         if data == b'':
             if D_SYNCTREE: log.debug('Received EOF')
             self.recv_tree_eof = True
             return {}
-        for pos in range(0, len(data), self.NODE_BYTES):
+        return self.decode_nodes(data)
+
+    def decode_nodes(self, data, offset=0):
+        ret = {}
+        for pos in range(offset, len(data), self.NODE_BYTES):
             chunk = data[pos:pos + self.NODE_BYTES]
             pos, id_xor, chk_xor = struct.unpack(self.NODE_FMT, chunk)
             ret[pos] = (id_xor, chk_xor)
         return ret
 
+    def send_levels(self, depth, nodes):
+        """Transfer nodes from `depth` consecutive levels of the synctree.
+
+        An empty `nodes` is sent the same way as an empty level, i.e. as EOF."""
+        if not nodes:
+            self.send_level(nodes)
+            return
+        if D_SYNCTREE: log.debug('Sending %d levels: %r', depth, nodes)
+        self.out_stream.write(struct.pack(self.SIZE_FMT, self.DEPTH_BYTES + len(nodes)*self.NODE_BYTES))
+        self.out_stream.write(struct.pack(self.DEPTH_FMT, depth))
+        for pos, (id_xor, chk_xor) in nodes.items():
+            self.out_stream.write(struct.pack(self.NODE_FMT, pos, id_xor, chk_xor))
+
+    async def recv_levels(self):
+        """Receive the result of `send_levels` as a tuple (depth, nodes). Depth is None on EOF."""
+        if self.recv_tree_eof: return None, {}
+        data = await self.recv_sized()
+        if data == b'':
+            if D_SYNCTREE: log.debug('Received EOF')
+            self.recv_tree_eof = True
+            return None, {}
+        depth, = struct.unpack_from(self.DEPTH_FMT, data)
+        return depth, self.decode_nodes(data, self.DEPTH_BYTES)
+
 
-    async def compute_diff(self): 
+    def choose_descent(self, groups, nodes):
+        """Choose how many levels to send at once below the alive `nodes`,
+        which form `groups` sparse groups of siblings (see `compute_diff`).
+
+        A sparse group probably holds just two differences (a single one is
+        found without recursing), which stay in one subtree for `depth` more
+        levels with probability ARITY**-depth. Sending one more level thus saves
+        a round trip only if it resolves the last such group. It costs (at most)
+        one node per syncable below each of the nodes, which is about
+        `len(nodes) * min(ARITY**depth, per_node)` nodes. We descend as long as
+        this extra data takes less time to transfer than the round trips it is
+        expected to save. Deep in the tree, where alive subtrees contain only
+        a few syncables, this descends many levels at once."""
+        synctree = self.synctree
+        if not self.speculative or not nodes or self.rtt is None:
+            return 1
+        lvl_num = min( synctree.pos_level(pos) for pos in nodes )
+        remaining = synctree.LEVELS - lvl_num
+        # Expected number of syncables below one node of this level
+        per_node = max(1, self.local_count >> (lvl_num * synctree.BITS_PER_LEVEL))
+        # Probability that some group is not resolved within `depth` levels
+        unresolved = lambda depth: 1 - (1 - synctree.ARITY ** -depth) ** groups
+        depth = 1
+        while depth < remaining:
+            extra = len(nodes) * min(synctree.ARITY ** depth, per_node) * self.NODE_BYTES
+            saved = unresolved(depth) - unresolved(depth + 1)
+            if extra > saved * self.rtt * self.bandwidth: break
+            depth += 1
+        return depth
+
+    def observe_exchange(self, duration, nbytes):
+        """Update link estimates used by `choose_descent`.
+
+        The round trip time is the shortest exchange seen so far, the rest of
+        an exchange is time spent transferring its data. The bandwidth is the
+        ratio of exponentially smoothed transfer sizes and times, starting from
+        DESCENT_BANDWIDTH, so that a single exchange finishing a bit faster
+        than the others cannot inflate it."""
+        if self.rtt is None or duration < self.rtt:
+            self.rtt = duration
+        if self.xfer_time is None:
+            self.xfer_time = self.rtt
+            self.xfer_bytes = self.rtt * self.DESCENT_BANDWIDTH
+        self.xfer_bytes += self.DESCENT_GAIN * (nbytes - self.xfer_bytes)
+        self.xfer_time += self.DESCENT_GAIN * (duration - self.rtt - self.xfer_time)
+        if self.xfer_time > 0:
+            self.bandwidth = self.xfer_bytes / self.xfer_time
+
+    def get_descendants(self, nodes, depth):
+        """Return all non-empty descendants of `nodes` at most `depth-1` levels below them."""
+        ret = {}
+        cur = nodes
+        for i in range(depth - 1):
+            below = {}
+            for pos in cur:
+                below.update(self.synctree.get_children(pos))
+            ret.update(below)
+            cur = below
+        return ret
+
+    @property
+    def speculative(self):
+        return self.DESCENT and self.did_hello and self.remote_hello.get('descent', False)
+
+    async def compute_diff(self):
         self.recv_tree_eof = False
-        lvl_num = self.START_LVL
-        start_off = start_size = 1 << self.START_LVL
-        lvl_alive = list(range(start_off, start_off + start_size))
+        self.rtt = None
+        self.xfer_bytes = self.xfer_time = None
+        self.bandwidth = self.DESCENT_BANDWIDTH
+        if self.scope is not None:
+            with self.db.ensure_transaction():
+                self.store.stage_scope(self.scope)
+                self.synctree = ScopedSyncTree(self.store.synctree)
+            self.local_count = len(self.synctree.ids)
+        else:
+            self.local_count = self.db.query_first('select coalesce(max(insert_order), 0) from syncables', _assoc=False)[0]
+        synctree = self.synctree
+        synctree.refresh_memtree()
+        lvl_num = min(-(-self.START_BITS // synctree.BITS_PER_LEVEL), synctree.LEVELS - 1)
+        # Nodes to compare in the next exchange, as groups of siblings (None
+        # for the whole start level). A group is sparse if only a few of the
+        # nodes next to its parent differed, so the parent's subtree probably
+        # holds only a few differences. Both sides know the same groups.
+        groups = None
         send_objects = []
         send_subtrees = []
-        while  lvl_num < SyncTree.LEVELS:
-            if D_SYNCTREE: log.debug("Level %d, alive %r", lvl_num, lvl_alive)
-            sent = self.get_xors(lvl_alive)
+        self.exchanges = 0
+        while True:
+            if groups is None:
+                sent = synctree.get_level(lvl_num)
+                first, last = synctree.level_range(lvl_num)
+                groups = [ (False, range(first, last + 1)) ]
+            else:
+                sent = self.get_xors([ pos for sparse, group in groups for pos in group ])
+            if D_SYNCTREE: log.debug("Alive groups %r", groups)
+            # With speculative descent, we also send the nodes of next depth-1
+            # levels below the alive nodes, all in one message. Both sides then
+            # compare min(our depth, their depth) levels before the next exchange.
+            # Saving an exchange needs all groups resolved, so we only descend
+            # when all of them are sparse.
+            if all( sparse for sparse, group in groups ):
+                depth = self.choose_descent(len(groups), list(sent))
+            else:
+                depth = 1
+            if self.speculative:
+                block = dict(sent)
+                block.update(self.get_descendants(sent, depth))
+                msg = ('levels', depth, block)
+            else:
+                block = sent
+                msg = ('level', sent)
             if not self.recv_tree_eof:
-                (recv,) = await self.exchange([('level', sent)], ['level'])
+                start_time = time.monotonic()
+                (recv,) = await self.exchange([msg], [msg[0]])
+                if msg[0] == 'levels':
+                    their_depth, recv = recv
+                    if their_depth is not None: depth = min(depth, their_depth)
+                self.observe_exchange(time.monotonic() - start_time, len(recv) * self.NODE_BYTES)
+                self.exchanges += 1
             if not sent:
                 if D_SYNCTREE: log.debug("Sent EOF, exiting")
                 break
-            next_lvl = []
-            for vert in sent:
-                my_val, my_chk = sent[vert]
-                their_val, their_chk = recv.get(vert, (SyncTree.ZERO,SyncTree.ZERO))
-                if D_SYNCTREE: log.debug("Vert %d: my %s/%s, their %s/%s", vert,
-                                    binhex(my_val), binhex(my_chk), binhex(their_val), binhex(their_chk))
-
-                if their_val == SyncTree.ZERO and their_chk == SyncTree.ZERO: # they have nothing, send whole subtree, no need to recurse
-                    send_subtrees.append(vert)
-                    continue
-
-                if my_val == their_val and my_chk == their_chk:
-                    continue # no changes
-
-                diff = binxor(my_val, their_val)
-                if SyncTree.hash_chk(diff) == binxor(my_chk, their_chk): # only single chnage in subtree
-                    if D_SYNCTREE: log.debug('Single change: %s', binhex(diff))
-                    hex_id = binhex(diff)
-                    if self.synctree.has(hex_id):
-                        send_objects.append(hex_id)
-                    continue
-
-                # all other cases: we have two different non-trivial subtrees, recurse on both ends
-                if lvl_num == SyncTree.LEVELS - 1:
-                    if D_SYNCTREE: log.debug("...leaf collision")
-                    send_subtrees.append(vert)
-                else:
-                    if D_SYNCTREE: log.debug("...recursing")
-                    child_base = vert << SyncTree.BITS_PER_LEVEL
-                    next_lvl += range(child_base, child_base + SyncTree.ARITY)
-            if self.recv_tree_eof:
+            if D_SYNCTREE and depth > 1: log.debug("Descending %d levels", depth)
+            todo = [ (group, depth) for sparse, group in groups ]
+            groups = []
+            while todo:
+                group, levels = todo.pop()
+                changed = 0
+                recurse = []
+                for vert in group:
+                    my_val, my_chk = block.get(vert, (SyncTree.ZERO,SyncTree.ZERO))
+                    their_val, their_chk = recv.get(vert, (SyncTree.ZERO,SyncTree.ZERO))
+                    if my_val == their_val and my_chk == their_chk:
+                        continue # no changes
+                    changed += 1
+                    if D_SYNCTREE: log.debug("Vert %d: my %s/%s, their %s/%s", vert,
+                                        binhex(my_val), binhex(my_chk), binhex(their_val), binhex(their_chk))
+
+                    if my_val == SyncTree.ZERO and my_chk == SyncTree.ZERO: # we have nothing, they send the whole subtree
+                        continue
+
+                    if their_val == SyncTree.ZERO and their_chk == SyncTree.ZERO: # they have nothing, send whole subtree, no need to recurse
+                        send_subtrees.append(vert)
+                        continue
+
+                    diff = binxor(my_val, their_val)
+                    if SyncTree.hash_chk(diff) == binxor(my_chk, their_chk): # only single chnage in subtree
+                        if D_SYNCTREE: log.debug('Single change: %s', binhex(diff))
+                        if self.synctree.has(diff):
+                            send_objects.append(diff)
+                        continue
+
+                    # all other cases: we have two different non-trivial subtrees, recurse on both ends
+                    if synctree.pos_level(vert) == synctree.LEVELS - 1:
+                        if D_SYNCTREE: log.debug("...leaf collision")
+                        send_subtrees.append(vert)
+                    else:
+                        if D_SYNCTREE: log.debug("...recursing")
+                        recurse.append(vert)
+                sparse = changed <= max(1, len(group) // 2)
+                for vert in recurse:
+                    child_base = vert << synctree.BITS_PER_LEVEL
+                    children = range(child_base, child_base + synctree.ARITY)
+                    # Children within the levels sent are compared now,
+                    # the others in the next exchange.
+                    if levels > 1:
+                        todo.append((children, levels - 1))
+                    else:
+                        groups.append((sparse, children))
+            # Both sides run out of groups at the same time, no need to exchange EOFs
+            if self.recv_tree_eof or not groups:
                 break
-            lvl_alive = next_lvl
-            lvl_num += 1
         if D_SYNCTREE:
             logging.debug('Send subtrees: %r', send_subtrees)
             logging.debug('Send objects: %r', send_objects)
+            logging.debug('Diff computed in %d exchanges', self.exchanges)
         return send_subtrees, send_objects
 
 
-    async def send_objects(self, what):
-        send_subtrees, send_objects = what
-        rows = []
-        for oid in send_objects:
-            rows.append(self.db.query_first("select insert_order, id, kind, origin_idx from syncables where id=?", oid))
-        for vert in send_subtrees:
-            minkey, maxkey = self.synctree.subtree_key_range(vert)
-            if D_SYNCTREE: log.debug('key range: %d - %d', minkey, maxkey)
-            rows += self.db.query("select insert_order, id, kind, origin_idx from syncables where tree_key >= ? and tree_key < ?",
-                                    minkey, maxkey)
-        # We need to send objects in insertion order, so that other side can
-        # recreate them without violating foreign key constraints
-        rows.sort(key=lambda row: row['insert_order'])
-        for row in rows:
-            try:
-                await self.send_by_syncable_row(row)
-            except:
-                import traceback
-                traceback.print_exc()
-        self.send_sized(b'')
-        await self.out_stream.drain()
+    def select_diff(self, db, diff):
+        send_subtrees, send_objects = diff
+        ranges = [ self.synctree.subtree_key_range(vert) for vert in send_subtrees ]
+        if D_SYNCTREE:
+            for minkey, maxkey in ranges: log.debug('key range: %d - %d', minkey, maxkey)
+        # Put the requested objects and subtrees into temporary tables and let
+        # SQLite select them all in one query.
+        self.stage_send_ids(db, send_objects)
+        db.execute('create temp table if not exists send_ranges (minkey integer, maxkey integer)')
+        db.execute('delete from temp.send_ranges')
+        db.executemany('insert into temp.send_ranges values (?,?)', ranges)
+        self.stage_send_selection(db, 'select insert_order from syncables where id in (select id from temp.send_ids)'
+                                      ' union select s.insert_order from temp.send_ranges r'
+                                      ' join syncables s on s.tree_key between r.minkey and r.maxkey')
+
+class IBLTMDSync(MDSync):
+    RESUMABLE = True
+    SCOPED_DIFF = True
+    CELL_FMT = '>l16s8s' # count, ID xor and hash xor
+    CELL_BYTES = struct.calcsize(CELL_FMT)
+    def __init__(self, store, file, **kw):
+        super().__init__(store=store, file=file, **kw)
+        self.iblt = store.iblt
+
+    def get_hello(self):
+        hello = super().get_hello()
+        hello['iblt'] = self.iblt.layout
+        return hello
+
+    def process_hello(self, remote_hello):
+        super().process_hello(remote_hello)
+        if remote_hello.get('iblt') != self.iblt.layout:
+            raise ProtocolError("IBLT layout mismatch (local %r, remote %r)."
+                                    % (self.iblt.layout, remote_hello.get('iblt')))
+
+    def send_cells(self, cells):
+        id_bytes, hash_bytes = self.iblt.ID_BYTES, self.iblt.HASH_BYTES
+        self.send_sized(b''.join( struct.pack(self.CELL_FMT, count, xor.to_bytes(id_bytes, 'big'),
+                                                chxor.to_bytes(hash_bytes, 'big'))
+                                    for count, xor, chxor in zip(*cells) ))
+
+    async def recv_cells(self):
+        data = await self.recv_sized()
+        counts, xors, chxors = cells = SyncIBLT.empty_cells(0)
+        for count, xor, chxor in struct.iter_unpack(self.CELL_FMT, data):
+            counts.append(count)
+            xors.append(int.from_bytes(xor, 'big'))
+            chxors.append(int.from_bytes(chxor, 'big'))
+        return cells
+
+    def send_ids(self, ids):
+        self.send_sized(b''.join(ids))
+
+    async def recv_ids(self):
+        data = await self.recv_sized()
+        n = self.iblt.ID_BYTES
+        return [ data[i:i+n] for i in range(0, len(data), n) ]
+
+    async def exchange_cells(self, cells):
+        (theirs,) = await self.exchange([('cells', cells)], ['cells'])
+        if len(theirs[0]) != len(cells[0]):
+            raise ProtocolError("Received IBLT of wrong size (%d cells instead of %d)" % (len(theirs[0]), len(cells[0])))
+        self.exchanges += 1
+        return self.iblt.subtract(cells, theirs)
+
+    async def compute_diff(self):
+        if self.scope is not None:
+            with self.db.ensure_transaction():
+                self.store.stage_scope(self.scope)
+                self.iblt = ScopedIBLT(self.store.iblt)
+        iblt = self.iblt
+        self.exchanges = 0
+        # Both sides decode the same difference (only with opposite signs), so
+        # they always agree on success and on what to exchange next.
+        difference, to_send = iblt.estimate_difference(await self.exchange_cells(iblt.load_strata()))
+        if D_IBLT: log.debug('Estimated difference: %d', difference)
+        if to_send is None:
+            bits = iblt.bits_for(difference)
+            while True:
+                if D_IBLT: log.debug('Trying IBLT with %d cells', iblt.HASHES << bits)
+                success, to_send, _ = iblt.decode(await self.exchange_cells(iblt.load_main(bits)), bits)
+                if success or bits >= iblt.MAIN_BITS: break
+                bits += 1
+            if not success:
+                # Difference too large even for the full IBLT, just exchange all IDs
+                log.info('IBLT decoding failed, exchanging full ID lists')
+                ids = iblt.all_ids()
+                (their_ids,) = await self.exchange([('ids', ids)], ['ids'])
+                self.exchanges += 1
+                their_ids = set(their_ids)
+                to_send = [ id for id in ids if id not in their_ids ]
+        # Guard against IDs produced by hash collisions
+        to_send = [ id for id in to_send if iblt.has(id) ]
+        if D_IBLT: log.debug('Diff computed in %d exchanges, sending %d objects', self.exchanges, len(to_send))
+        return to_send
+
+    def select_diff(self, db, diff):
+        self.stage_send_ids(db, diff)
+        self.stage_send_selection(db, 'select insert_order from syncables where id in (select id from temp.send_ids)')
 
 class SerialMDSync(MDSync):
     async def compute_diff(self):
@@ -239,77 +1132,213 @@ class SerialMDSync(MDSync):
         if to_send:
             origin_conds = " or ".join(  "(origin_idx=%d and serial>=%d)"%(origin_idx, start)
                                          for (origin_idx, origin_id, start) in to_send  )
-            # Send in local insertion order to guarantee referential correctness of inserts on target.
-            query = "select * from syncables where %s order by insert_order asc" % origin_conds
-            for row in self.db.query(query):
-                await self.send_by_syncable_row(row)
-        self.send_sized(b'')
-        log.info('Sending done')
-        await self.shutdown()
+            await self.send_selected(lambda db: self.stage_send_selection(
+                                        db, "select insert_order from syncables where %s" % origin_conds))
 
 
-def main(store, target=None, *, listen:int=None):
+class MDSyncServer:
+    """Serve metadata sync to many peers from a single event loop.
+
+    Sessions run on a bounded pool of long-lived store connections (keeping
+    memtrees and SQLite caches warm between clients); peers connecting while
+    all of them are busy wait for one to be freed. Diff computation and object
+    reading happen on the session's own connection, while all received objects
+    are applied by one shared writer thread. Live sessions (see `MDSync.live`)
+    keep their worker until the client disconnects."""
+    def __init__(self, open_store, path, workers, compress=None, live=False):
+        self.compress = compress
+        self.live = live
+        self.pool = asyncio.Queue()
+        for i in range(workers):
+            st = open_store(path)
+            self.pool.put_nowait((st, Store(st.root_path)))
+        self.writer = ObjectWriter(st.root_path, MDSync.DB_QUEUE_SIZE)
+
+    async def handle(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.pool.empty():
+            log.info("Client connected from %s, waiting for a free worker", addr)
+        st, prefetch_st = await self.pool.get()
+        log.info("Client connected from %s", addr)
+        try:
+            mdsync = MDSync(store=st, file=(reader, writer), compress=self.compress,
+                            writer=self.writer, prefetch_store=prefetch_st, live=self.live)
+            await mdsync.run()
+        except (OSError, EOFError) as e:
+            log.warning("Connection with %s lost: %s", addr, e)
+        except Exception:
+            log.exception("Sync with %s failed", addr)
+        finally:
+            writer.close()
+            self.pool.put_nowait((st, prefetch_st))
+        log.info("Client %s done", addr)
+
+    async def serve(self, port):
+        server = await asyncio.start_server(self.handle, port=port, reuse_address=True)
+        log.info("Listening on %d", port)
+        await server.serve_forever()
+
+class MDSyncFanOut:
+    """Synchronize one store with several peers at once.
+
+    All sessions compute their diffs on one shared connection, so the synctree
+    (loaded as a memtree) or the folded IBLTs are computed only once, and they
+    share one de-duplicating writer, so an object sent by several peers is
+    only written once. No session starts exchanging objects before all diffs
+    are done: they thus all see the same store and writes do not invalidate
+    the shared tables in the middle."""
+    def __init__(self, store, open_store, compress=None):
+        self.store = store
+        self.open_store = open_store
+        self.compress = compress
+        if store.sync_mode == 'synctree':
+            store.synctree.enable_memtree()
+        self.writer = ObjectWriter(store.root_path, MDSync.DB_QUEUE_SIZE, dedup=True)
+        self.diffing = 0
+        self.diffs_done = asyncio.Event()
+
+    def diff_done(self):
+        self.diffing -= 1
+        if not self.diffing: self.diffs_done.set()
+
+    async def sync(self, target):
+        """Sync with one target (a local directory or ip:port). Return whether it succeeded."""
+        in_diff = True
+        async def barrier():
+            nonlocal in_diff
+            in_diff = False
+            self.diff_done()
+            await self.diffs_done.wait()
+        compress = self.compress
+        tasks = []
+        try:
+            if os.path.isdir(target):
+                # Compression only costs CPU time locally unless explicitly requested
+                if compress is None: compress = []
+                sock1, sock2 = socket.socketpair(socket.AF_UNIX)
+                other = MDSync(store=self.open_store(target), file=sock2, compress=compress)
+                tasks.append(asyncio.ensure_future(other.run()))
+                file = sock1
+            else:
+                ip, port = target.rsplit(':', 1)
+                log.info('Connecting to %s', target)
+                file = await asyncio.open_connection(ip, int(port))
+            mdsync = MDSync(store=self.store, file=file, compress=compress, writer=self.writer, initiator=True)
+            tasks.append(asyncio.ensure_future(mdsync.run(barrier=barrier)))
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for fut in done: fut.result()
+            log.info('Synced with %s', target)
+            return True
+        except Exception:
+            log.exception('Sync with %s failed', target)
+            return False
+        finally:
+            for fut in tasks: fut.cancel()
+            if tasks: await asyncio.wait(tasks)
+            if in_diff: self.diff_done()
+
+    async def run(self, targets):
+        """Sync with all `targets`, return the number of failed ones."""
+        self.diffing = len(targets)
+        results = await asyncio.gather(*( self.sync(target) for target in targets ))
+        await self.writer.stop()
+        return results.count(False)
+
+async def sync_live(store, ip, port, compress=None):
+    """Sync with a server in live mode until interrupted.
+
+    Whenever the connection is lost, we reconnect after a delay, which starts
+    with a normal sync to catch up on what we missed."""
+    while True:
+        try:
+            log.info('Connecting to %s:%s', ip, port)
+            file = await asyncio.open_connection(ip, port)
+            try:
+                mdsync = MDSync(store=store, file=file, compress=compress, live=True, initiator=True)
+                await mdsync.run()
+                if not mdsync.live_enabled:
+                    log.error('The server does not allow live sync (see --live)')
+                    return
+            finally:
+                file[1].close()
+        except (OSError, EOFError, ProtocolError, asyncio.TimeoutError) as e:
+            log.warning('Live sync with %s:%s interrupted: %s', ip, port, e)
+        await asyncio.sleep(MDSync.RECONNECT_DELAY)
+
+def main(store, *targets, listen:int=None, workers:int=4, memtree=False, compress=None, live=False):
     """
     :param store: the local store path
-    :param target: the synchronization target: either another local directory, an ip:port or '-' for stdio.
+    :param targets: the synchronization targets: each either another local directory, an ip:port or '-' for stdio.
+        With several targets (not stdio), sync with all of them at once.
     :param listen: start server on given port instead
+    :param workers: the number of peers a server syncs with at once, others have to wait
+    :param memtree: load the synctree into memory for faster diff computation
+    :param compress: comma-separated compression methods to allow (zlib, lzma), in order of
+        preference, or 'none', default all
+    :param live: after syncing, stay connected and push changes to the other side as they
+        happen (the other side must use --live too). Clients reconnect when the connection is lost.
     """
 
-    if listen and target:
+    if compress is not None:
+        compress = [] if compress == 'none' else compress.split(',')
+        for name in compress:
+            if name not in CODECS: raise ArgumentError("Unknown compression method %r" % name)
+
+    def open_store(path):
+        st, sub = Store.find(path)
+        if sub != Path(): raise ArgumentError("Metadata sync must be done on whole store (%s), not a subtree." % st.root_path)
+        if memtree and st.sync_mode == 'synctree':
+            st.synctree.enable_memtree()
+        return st
+
+    if listen and targets:
         raise ArgumentError("--listen cannot be specified with a target")
     elif listen:
-        procs = []
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('0.0.0.0', listen))
-        sock.listen(5)
-        log.info("Listening on %d", listen)
-
-        def server_process(sock):
-            st, sub = Store.find(store)
-            if sub != Path(): raise ArgumentError("Metadata sync must be done on whole store (%s), not a subtree." % st.root_path)
-            mdsync = MDSync(store=st, file=sock)
-            asyncio.get_event_loop().run_until_complete(mdsync.run())
-
-        while True:
-            client, addr = sock.accept()
+        if workers < 1: raise ArgumentError("--workers must be at least 1")
+        server = MDSyncServer(open_store, store, workers, compress=compress, live=live)
+        asyncio.get_event_loop().run_until_complete(server.serve(listen))
 
-            log.info("Client connected from %s", addr)
-            #server_process(client)
-            proc = multiprocessing.Process(target=server_process, args=(client,))
-            proc.start()
-            client.close() # the new process has the socket, we must close it for EOF to work
-            procs.append(proc)
+    elif len(targets) > 1:
+        if live: raise ArgumentError("--live cannot be used with several targets")
+        for target in targets:
+            if not os.path.isdir(target) and ':' not in target:
+                raise ArgumentError("Invalid target %r, only directories and ip:port can be used with several targets" % target)
+        fanout = MDSyncFanOut(open_store(store), open_store, compress=compress)
+        failed = asyncio.get_event_loop().run_until_complete(fanout.run(targets))
+        if failed: err("Sync with %d of %d targets failed" % (failed, len(targets)))
+        return
+    elif not targets:
+        raise ArgumentError("Missing target (see --help)")
+    target, = targets
 
     # .buffer is for binary stdio
-    st, sub = Store.find(store)
-    if sub != Path(): raise ArgumentError("Metadata sync must be done on whole store (%s), not a subtree." % st.root_path)
+    st = open_store(store)
 
     if os.path.isdir(target):
-        target_st, sub = Store.find(target)
-        if sub != Path(): raise ArgumentError("Metadata sync must be done on whole store (%s), not a subtree." % target_st.root_path)
-
-        # We currently push data through a pipe for local sync. This is ugly,
-        # could be changed with some minor work.
-        #ab_r, ab_w = os.pipe()
-        #ba_r, ba_w = os.pipe()
-        sock1, sock2 = socket.socketpair(socket.AF_UNIX)
-
-        mdsync = MDSync(store=st, file=sock1)
-        mdsync2 = MDSync(store=target_st, file=sock2)
-        task = asyncio.wait([mdsync.run(), mdsync2.run()],
-                                return_when=asyncio.FIRST_EXCEPTION)
-        asyncio.get_event_loop().run_until_complete(task)
+        if live: raise ArgumentError("--live needs a server or stdio as the target")
+        target_st = open_store(target)
+        if target_st.sync_mode != st.sync_mode:
+            raise ArgumentError("Cannot sync stores with different sync modes (%s, %s)"
+                                    % (st.sync_mode, target_st.sync_mode))
+        # Both stores are on this host, copy directly between the databases
+        scope = intersect_scopes(st.scope, target_st.scope)
+        copied = target_st.copy_from(st, scope)
+        log.info('Copied %d objects to %s', copied, target_st.root_path)
+        copied = st.copy_from(target_st, scope)
+        log.info('Copied %d objects to %s', copied, st.root_path)
         return
     elif target == '-':
-        mdsync = MDSync(store=st, file=(sys.stdin.buffer, sys.stdout.buffer))
+        mdsync = MDSync(store=st, file=(sys.stdin.buffer, sys.stdout.buffer), compress=compress, live=live)
         asyncio.get_event_loop().run_until_complete(mdsync.run())
     elif ':' in target:
         ip,port = target.split(':')
+        if live:
+            asyncio.get_event_loop().run_until_complete(sync_live(st, ip, int(port), compress=compress))
+            return
         log.info('Connecting to %s', target)
         rd,wr = asyncio.get_event_loop().run_until_complete(asyncio.open_connection(ip, int(port)))
         log.info('Connected to %s, starting sync', target)
-        mdsync = MDSync(store=st, file=(rd,wr))
+        mdsync = MDSync(store=st, file=(rd,wr), compress=compress, initiator=True)
         asyncio.get_event_loop().run_until_complete(mdsync.run())
     else:
         raise ArgumentError("Invalid target (see --help)")
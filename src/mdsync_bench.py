@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+"""Benchmark of metadata sync on synthetic stores.
+
+Two stores sharing a common set of syncables, each with some syncables the
+other does not have, are synced by real mdsync sessions running in one
+process and connected through a simulated network link with configurable
+latency and bandwidth. The results are printed as JSON."""
+
+from utils import *
+from store import *
+from mdsync import MDSync
+import init
+
+import logging
+log = logging.getLogger('filoco.mdsync_bench')
+
+import socket, shutil, tempfile, json
+
+# Files per generated directory
+FILES_PER_DIR = 100
+LINK_READ_SIZE = 1 << 16
+# Extra diff data (relative) allowed for speculative descent that saved no round
+# trip. Descent is a guess which sometimes does not pay off.
+DESCENT_TOLERANCE = 0.05
+
+def count_syncables(store):
+    return store.db.query_first('select count(*) from syncables', _assoc=False)[0]
+
+def generate(store, count, prefix):
+    """Add at least `count` syncables to `store`, as top-level directories of
+    files whose names start with `prefix`. Return the number actually added."""
+    before = count_syncables(store)
+    with store.db.bulk_transaction():
+        added = 0
+        i = 0
+        while added < count:
+            if i % FILES_PER_DIR == 0:
+                dir_fob, _, _ = store.create_fob(type='d', name='%s%d' % (prefix, i // FILES_PER_DIR))
+                added += 2
+            store.create_fob(type='r', name='f%d' % i, parent=dir_fob)
+            added += 3
+            i += 1
+    return count_syncables(store) - before
+
+def create_pair(workdir, sync_mode, syncables, divergent):
+    """Create stores `a` and `b` in `workdir` with `syncables` common syncables
+    and `divergent` ones only in each of them. Return the actual counts."""
+    a_path, b_path = os.path.join(workdir, 'a'), os.path.join(workdir, 'b')
+    os.mkdir(a_path)
+    cwd = os.getcwd()
+    try:
+        init.main(a_path, sync_mode=sync_mode, scope=())
+        a = Store(a_path)
+        common = generate(a, syncables, 'common')
+        a.db.execute('pragma wal_checkpoint(truncate)')
+        os.mkdir(b_path)
+        init.main(b_path, clone=a_path, scope=())
+    finally:
+        os.chdir(cwd)
+    b = Store(b_path)
+    only_a = generate(a, divergent, 'a')
+    only_b = generate(b, divergent, 'b')
+    for st in (a, b):
+        st.db.execute('pragma wal_checkpoint(truncate)')
+    return {'common': common, 'only_a': only_a, 'only_b': only_b}
+
+class Link:
+    """One direction of a simulated network link.
+
+    Data are read as soon as they are written, which is when they are
+    counted, and delivered after the transmission time at `bandwidth`
+    (bytes per second, 0 for unlimited) plus `latency` (seconds)."""
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.bytes = 0
+        self.busy_until = 0
+        self.queue = asyncio.Queue()
+
+    async def receive(self, reader):
+        while True:
+            data = await reader.read(LINK_READ_SIZE)
+            if not data: break
+            self.bytes += len(data)
+            now = time.monotonic()
+            if self.bandwidth:
+                self.busy_until = max(now, self.busy_until) + len(data) / self.bandwidth
+                now = self.busy_until
+            self.queue.put_nowait((now + self.latency, data))
+        self.queue.put_nowait((None, None))
+
+    async def deliver(self, writer):
+        while True:
+            due, data = await self.queue.get()
+            if data is None: break
+            delay = due - time.monotonic()
+            if delay > 0: await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+        writer.write_eof()
+
+    async def run(self, reader, writer):
+        await asyncio.gather(self.receive(reader), self.deliver(writer))
+
+class Session:
+    """One side of a benchmarked sync, recording when its diff is done."""
+    def __init__(self, store, sock, link, compress, descent=True, initiator=False):
+        self.mdsync = MDSync(store=store, file=sock, compress=compress, initiator=initiator)
+        if not descent: self.mdsync.DESCENT = False
+        self.link = link
+        self.round_trips = 0
+        exchange = self.mdsync.exchange
+        async def counting_exchange(*args):
+            self.round_trips += 1
+            return await exchange(*args)
+        self.mdsync.exchange = counting_exchange
+
+    async def diff_done(self):
+        self.diff_time = time.monotonic()
+        self.diff_bytes = self.link.bytes
+
+    async def run(self):
+        await self.mdsync.run(barrier=self.diff_done)
+        self.end_time = time.monotonic()
+
+async def bench_sync(a, b, latency, bandwidth, compress, descent=True):
+    """Sync stores `a` and `b` over a simulated link, return a dict of measurements.
+
+    `descent` turns off speculative descent in synctree mode when false."""
+    a_sock, a_relay = socket.socketpair(socket.AF_UNIX)
+    b_sock, b_relay = socket.socketpair(socket.AF_UNIX)
+    a_to_b, b_to_a = Link(latency, bandwidth), Link(latency, bandwidth)
+    a_reader, a_writer = await asyncio.open_connection(sock=a_relay)
+    b_reader, b_writer = await asyncio.open_connection(sock=b_relay)
+    before = count_syncables(a) + count_syncables(b)
+    sides = [ Session(a, a_sock, a_to_b, compress, descent, initiator=True), Session(b, b_sock, b_to_a, compress, descent) ]
+    start = time.monotonic()
+    await asyncio.gather(a_to_b.run(a_reader, b_writer), b_to_a.run(b_reader, a_writer),
+                         *( side.run() for side in sides ))
+    for writer in (a_writer, b_writer): writer.close()
+    end = max( side.end_time for side in sides )
+    diff_end = max( side.diff_time for side in sides )
+    diff_bytes = sum( side.diff_bytes for side in sides )
+    total_bytes = a_to_b.bytes + b_to_a.bytes
+    # Counted on the receiving side, which includes objects sent when resuming
+    objects = count_syncables(a) + count_syncables(b) - before
+    return {
+        'wall_time': end - start,
+        'diff_time': diff_end - start,
+        'objects_time': end - diff_end,
+        'round_trips': max( side.round_trips for side in sides ),
+        'bytes': {'diff': diff_bytes, 'objects': total_bytes - diff_bytes, 'total': total_bytes},
+        'objects': objects,
+        'objects_per_s': objects / (end - diff_end) if end > diff_end else None,
+    }
+
+def copy_store(src, dst):
+    shutil.copytree(src, dst, symlinks=True)
+    return Store(dst)
+
+def main(*, syncables:int=10000, divergent:int=100, modes='serial,synctree,iblt', latency:float=0,
+         bandwidth:float=0, compress=None, memtree=False, repeat:int=1, output=None, workdir=None,
+         verbose:'v'=False):
+    """
+    :param syncables: number of syncables both stores have
+    :param divergent: number of syncables only one store has (each of them gets this many)
+    :param modes: comma-separated sync modes to benchmark
+    :param latency: one-way latency of the simulated link in milliseconds
+    :param bandwidth: bandwidth of the simulated link in KiB/s in each direction, 0 for unlimited
+    :param compress: comma-separated compression methods to allow (zlib, lzma) or 'none', default all
+    :param memtree: load the synctree into memory (synctree mode)
+    :param repeat: number of runs of each mode
+    :param output: write the report to this file instead of the standard output
+    :param workdir: directory for the generated stores, created if needed (a temporary one by
+        default, removed afterwards)
+    :param verbose: show log messages of the sync sessions
+    """
+    modes = modes.split(',')
+    for mode in modes:
+        if mode not in SYNC_MODES:
+            raise ArgumentError("Unknown sync mode %r (choose from %s)" % (mode, ', '.join(SYNC_MODES)))
+    if compress is not None:
+        compress = [] if compress == 'none' else compress.split(',')
+        for name in compress:
+            if name not in CODECS: raise ArgumentError("Unknown compression method %r" % name)
+    if not verbose:
+        # Only our own progress messages
+        logging.getLogger().setLevel(logging.WARNING)
+        log.setLevel(logging.INFO)
+
+    if workdir is None:
+        tmpdir = workdir = tempfile.mkdtemp(prefix='mdsync-bench-')
+    else:
+        tmpdir = None
+        workdir = os.path.realpath(workdir)
+        os.makedirs(workdir, exist_ok=True)
+    loop = asyncio.get_event_loop()
+    results = []
+    try:
+        for mode in modes:
+            pristine = os.path.join(workdir, mode)
+            os.mkdir(pristine)
+            log.info("Generating %s stores", mode)
+            start = time.monotonic()
+            counts = create_pair(pristine, mode, syncables, divergent)
+            log.info("Generated %r in %.1f s", counts, time.monotonic() - start)
+            for i in range(repeat):
+                # Synctree mode is also run without speculative descent, to check
+                # that descent does not send more data for nothing
+                for descent in ((True, False) if mode == 'synctree' else (True,)):
+                    run_dir = os.path.join(workdir, '%s-run%d%s' % (mode, i, '' if descent else '-nodescent'))
+                    os.mkdir(run_dir)
+                    a = copy_store(os.path.join(pristine, 'a'), os.path.join(run_dir, 'a'))
+                    b = copy_store(os.path.join(pristine, 'b'), os.path.join(run_dir, 'b'))
+                    if memtree and mode == 'synctree':
+                        for st in (a, b): st.synctree.enable_memtree()
+                    result = {'mode': mode, 'run': i, 'syncables': counts, 'latency_ms': latency,
+                              'bandwidth_kib': bandwidth or None, 'compress': compress, 'memtree': memtree,
+                              'descent': descent if mode == 'synctree' else None}
+                    result.update(loop.run_until_complete(bench_sync(a, b, latency / 1000, bandwidth * 1024,
+                                                                     compress, descent)))
+                    a_ids, b_ids = ( set( row[0] for row in st.db.query('select id from syncables', _assoc=False) )
+                                        for st in (a, b) )
+                    result['converged'] = a_ids == b_ids
+                    log.info("%s run %d%s: %.3f s, %d round trips, %d bytes", mode, i, '' if descent else ' (no descent)',
+                             result['wall_time'], result['round_trips'], result['bytes']['total'])
+                    results.append(result)
+                    del a, b
+                    shutil.rmtree(run_dir)
+                if mode == 'synctree':
+                    with_descent, without = results[-2:]
+                    with_descent['descent_regressed'] = (with_descent['bytes']['diff']
+                                                            > without['bytes']['diff'] * (1 + DESCENT_TOLERANCE)
+                                                         and with_descent['round_trips'] >= without['round_trips'])
+    finally:
+        if tmpdir is not None: shutil.rmtree(tmpdir)
+
+    report = json.dumps(results, indent=2)
+    if output is None:
+        print(report)
+    else:
+        spurt(output, report + '\n')
+    if not all( result['converged'] for result in results ):
+        err("Some syncs did not converge")
+    if any( result.get('descent_regressed') for result in results ):
+        err("Speculative descent sent more diff data without saving round trips")
+
+if __name__ == '__main__':
+    run(main)
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 
-import sys, os, posix, stat
+import sys, os, posix, stat, struct
 import logging
 import asyncio
 from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from butter.fanotify import *
 from butter.fhandle import *
@@ -32,13 +33,143 @@ init_debug(('queue','scan','mdupdate'))
 
 ScanRequest = namedtuple('ScanRequest', 'prio seq action target')
 # An item in the scan queue.
-# prio: the sort priority (usually the inode number to faciliate sequential access,
-#       but it could also be real importance-based priority)
+# prio: the sort priority (usually a (sweep, inode number) key from InodeSweep to
+#       faciliate sequential access, but it could also be real importance-based priority)
 # action: one of
 SR_CHECK = 1 # do a stat and compare type/size/mtime do rescan if necessary
 SR_SCAN = 2  # do a full rescan of contents (i.e., readdir)
 SR_SCAN_RECURSIVE = 3 # ...and recurse to all subdirs
 
+class InodeSweep:
+    """Scan order by inode number in repeated ascending sweeps (like a disk elevator).
+
+    Inode numbers correspond monotonically to inode locations on disk, so visiting
+    inodes in ascending order reads the inode tables of each block group
+    sequentially. Inodes discovered behind the current position (e.g. children
+    of a directory with a higher number) are left for the next sweep instead of
+    seeking back for each of them."""
+    def __init__(self):
+        self.sweep = 0
+        self.pos = 0
+
+    def key(self, ino):
+        """Return the sort key for visiting `ino`."""
+        return (self.sweep + 1 if ino < self.pos else self.sweep, ino)
+
+    def visit(self, key):
+        """Move to the position of a popped `key`."""
+        self.sweep, self.pos = key
+
+class InodeReadahead:
+    """Readahead hints for the inode tables of an ext2/3/4 filesystem.
+
+    The location of an inode on these filesystems is computed from its number:
+    its block group and index within that group's inode table. Before we stat
+    inodes, we ask the kernel to start reading the regions of inode tables that
+    contain them (`posix_fadvise(WILLNEED)` on the block device, whose page cache
+    the filesystem uses for metadata), so that whole regions are read with few
+    seeks instead of one inode block at a time."""
+    EXT_MAGIC = 0xEF53
+    INCOMPAT_64BIT = 0x80
+    # How much of an inode table to read ahead at once
+    REGION_SIZE = 256 << 10
+
+    def __init__(self, fd):
+        self.fd = fd
+        sb = os.pread(fd.fd, 1024, 1024)
+        (self.inodes_count,) = struct.unpack_from('<I', sb, 0x00)
+        first_data_block, log_block_size = struct.unpack_from('<II', sb, 0x14)
+        (self.inodes_per_group,) = struct.unpack_from('<I', sb, 0x28)
+        (magic,) = struct.unpack_from('<H', sb, 0x38)
+        (rev_level,) = struct.unpack_from('<I', sb, 0x4C)
+        (inode_size,) = struct.unpack_from('<H', sb, 0x58)
+        (feature_incompat,) = struct.unpack_from('<I', sb, 0x60)
+        (desc_size,) = struct.unpack_from('<H', sb, 0xFE)
+        if magic != self.EXT_MAGIC:
+            raise ValueError("Not an ext2/3/4 filesystem")
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level else 128
+        self.is_64bit = bool(feature_incompat & self.INCOMPAT_64BIT)
+        self.desc_size = desc_size if self.is_64bit else 32
+        self.gdt_offset = (first_data_block + 1) * self.block_size
+        self.inode_tables = {}
+        self.start = self.end = 0
+
+    @classmethod
+    def open(cls, store):
+        """Return readahead for the device of `store`, or None if not possible
+        (not ext2/3/4, not a block device or no permission to read it)."""
+        st = os.fstat(store.root_fd)
+        try:
+            uevent = slurp('/sys/dev/block/%d:%d/uevent' % (os.major(st.st_dev), os.minor(st.st_dev)))
+            devname = dict( line.split('=', 1) for line in uevent.splitlines() if '=' in line )['DEVNAME']
+            ra = cls(FD.open('/dev/' + devname, os.O_RDONLY))
+        except (OSError, KeyError, ValueError, struct.error) as e:
+            log.debug("Inode table readahead not available: %s", e)
+            return None
+        log.debug("Inode table readahead on /dev/%s", devname)
+        return ra
+
+    def inode_table(self, group):
+        """Return the byte offset of the inode table of block group `group`."""
+        try:
+            return self.inode_tables[group]
+        except KeyError:
+            desc = os.pread(self.fd.fd, self.desc_size, self.gdt_offset + group * self.desc_size)
+            (block,) = struct.unpack_from('<I', desc, 0x08)
+            if self.is_64bit:
+                block |= struct.unpack_from('<I', desc, 0x28)[0] << 32
+            self.inode_tables[group] = offset = block * self.block_size
+            return offset
+
+    def hint(self, ino):
+        """Start reading the inode table region containing inode `ino` (and following ones)."""
+        if not 0 < ino <= self.inodes_count: return
+        group, index = divmod(ino - 1, self.inodes_per_group)
+        table = self.inode_table(group)
+        offset = table + index * self.inode_size
+        if self.start <= offset < self.end: return
+        offset -= offset % self.block_size
+        end = min(offset + self.REGION_SIZE, table + self.inodes_per_group * self.inode_size)
+        os.posix_fadvise(self.fd.fd, offset, end - offset, os.POSIX_FADV_WILLNEED)
+        self.start, self.end = offset, end
+
+class SyscallPool:
+    """Worker threads doing the blocking syscalls of a scan (readdir, open, fstat,
+    name_to_handle_at, open_by_handle_at) ahead of the thread that applies the
+    results to the database.
+
+    The syscalls release the GIL, so several of them can be in flight at once,
+    which lets the disk (or the SSD's command queue) reorder the requests on cold
+    caches. With `workers=0`, everything is done synchronously by the caller."""
+    def __init__(self, workers, depth):
+        if depth < 1: raise ValueError("Queue depth must be at least 1")
+        self.executor = ThreadPoolExecutor(workers) if workers else None
+        self.depth = depth
+
+    def map(self, func, items):
+        """Yield `(item, future)` for each of `items` in order, the future holding
+        the result of `func(item)`. At most `depth` items are processed ahead of
+        the consumer."""
+        if self.executor is None:
+            for item in items:
+                fut = Future()
+                try: fut.set_result(func(item))
+                except Exception as e: fut.set_exception(e)
+                yield item, fut
+            return
+        pending = deque()
+        for item in items:
+            pending.append((item, self.executor.submit(func, item)))
+            if len(pending) >= self.depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
 class Scanner:
     # TODO: Running two scanners in parallel in the same repo might wreak havoc.
     #       Either fix or add some kind of locking.
@@ -46,13 +177,18 @@ class Scanner:
     SCAN_QUEUE_SIZE = 0 # TODO: do we want to limit this?
     QUEUE_MAX_FDS = 1000
     FANOTIFY_INTERVAL = 5
+    # Syscall worker threads and how many directory entries or queued inodes they
+    # may process ahead of the database writer (see SyscallPool)
+    WORKERS = 8
+    QUEUE_DEPTH = 64
     # How many seconds to wait before creating a FOB for a new inode. This is necessary
     # to handle the copy-and-rewrite idiom. If the temporary copy replaces an existing
     # FOB within this timeframe, it will be considered a new version of that FOB instead
     # of creating a new FOB.
     FOB_CREATE_WAIT = 30
 
-    def __init__(self, dir, *, watch_mode='none', init_scan=None, recursive=False):
+    def __init__(self, dir, *, watch_mode='none', init_scan=None, recursive=False, initial_import=False,
+                 workers=WORKERS, queue_depth=QUEUE_DEPTH, readahead=True):
         #if not is_mountpoint(dir):
         #    err("Watched directory '%s' must be a mountpoint."
         #            " The -m option might help with that." % args.dir)
@@ -60,6 +196,9 @@ class Scanner:
         self.db = self.store.db
         self.root_fd = self.store.root_fd
         self.scan_queue = asyncio.PriorityQueue(self.SCAN_QUEUE_SIZE)
+        self.pool = SyscallPool(workers, queue_depth)
+        self.sweep = InodeSweep()
+        self.readahead = InodeReadahead.open(self.store) if readahead else None
         self.queue_fds = 0
         self.last_queue_seq = 0
         self.loop = asyncio.get_event_loop()
@@ -69,11 +208,14 @@ class Scanner:
             else: init_scan = 'pending'
         self.init_scan = init_scan
         self.recursive = recursive
+        self.initial_import = initial_import
         self.scan_task = None
         self.from_notify = False
         self.total_scanned = 0
         if self.start_path != Path() and not self.recursive:
             raise ValueError("Scanning a specific subtree is only supported with -r")
+        if self.initial_import and self.start_path != Path():
+            raise ValueError("Initial import must be done on the whole store")
 
     def on_fanotify_event(self, event):
         fd = FD(event.fd)
@@ -120,10 +262,17 @@ class Scanner:
             await asyncio.sleep(self.FANOTIFY_INTERVAL)
 
 
-    def push_scan(self, action, target):
+    def hint(self, ino):
+        """Tell that we are going to stat inode `ino` soon."""
+        if self.readahead and ino:
+            self.readahead.hint(ino)
+
+    def push_scan(self, action, target, ino=None):
+        """Queue a scan request. `ino` is the inode number of the target if it is
+        known (e.g. from `getdents`) but the target was not stat'ed."""
         if self.queue_fds >= self.QUEUE_MAX_FDS:
             target.release_fd()
-        prio = target.ino or 0
+        prio = self.sweep.key(target.ino or ino or 0)
         self.last_queue_seq += 1
         sr = ScanRequest(prio, self.last_queue_seq, action, target)
         if D_QUEUE: log.debug("Queueing %r", sr)
@@ -136,11 +285,11 @@ class Scanner:
         for row in self.db.query('select * from inodes where '+where, *args):
             self.push_scan(action, InodeInfo.from_db(self.store, row))
 
-    def check(self, info):
+    def check(self, info, *, fresh_stat=False):
         if D_SCAN: log.debug('Checking %r', info)
         if not info.iid: raise ValueError("Cannot recheck object not in database")
         try:
-            st = info.get_stat(True)
+            st = info.get_stat(force=not fresh_stat)
         except (StaleHandle, FileNotFoundError):
             self.store.delete_inode(info)
             #self.store.delete_object(info) # TODO delete from database
@@ -153,22 +302,22 @@ class Scanner:
             # in cache.
             self.scan(info, fresh_stat=True)
 
-    def scan(self, info, *, obj=None, fresh_stat=False, recursive=False):
+    def scan(self, info, *, obj=None, fresh_stat=False, recursive=False, entries=None):
         if obj is None:
             obj = self.store.find_inode(info)
             if obj is None: return
         try:
             info.get_stat(force=not fresh_stat)
         except (FileNotFoundError, StaleHandle):
-            self.db.execute('delete from inodes where iid=?', obj.iid)
+            self.store.delete_inode(info)
             return
         if info.type == 'd':
-            self.scan_dir(info, dirobj=obj, fresh_stat=True, recursive=recursive)
+            self.scan_dir(info, dirobj=obj, fresh_stat=True, recursive=recursive, entries=entries)
         else:
             if info.type == 'r' and obj.fob:
                 with self.db.ensure_transaction():
                     new_fcv = self.store.create_working_version(obj.fob, obj.fcv)
-                    self.db.update('inodes', 'iid=?', info.iid, fcv=new_fcv, scan_state=SCAN_UP_TO_DATE,
+                    self.store.update_inode(obj.ino, fcv=new_fcv, scan_state=SCAN_UP_TO_DATE,
                                 size=info.stat.st_size, mtime=info.stat.st_mtime)
                     obj.fcv = new_fcv
             else:
@@ -177,7 +326,52 @@ class Scanner:
 
             
 
-    def scan_dir(self, dirinfo, *, dirobj=None, fresh_stat=False, recursive=False):
+    def read_dir(self, dirinfo):
+        """List the entries of a directory to be scanned, without `.filoco` and invalid names.
+
+        The entries are sorted by inode number (`d_ino` from `getdents`), so that
+        they are stat'ed in on-disk order."""
+        entries = []
+        for entry in fdscandir(dirinfo.get_fd()):
+            if entry.name == '.filoco': continue
+            try:
+                entry.name.encode('utf-8')
+            except UnicodeEncodeError:
+                log.warning('Invalid UTF-8 name: %s/%s. Skipping.', ascii(frealpath(dirinfo.fd)), ascii(entry.name))
+                continue
+            entries.append(entry)
+        entries.sort(key=lambda entry: entry.inode())
+        return entries
+
+    def probe(self, dir_fd, entry):
+        """Open, stat and get the handle of a directory entry. Runs in a worker thread."""
+        # Grab an O_PATH file descriptor to guarantee that all the subsequent
+        # operations (fstat, name_to_handle_at, ...) refer to the same inode,
+        # even if the name is replaced.
+        fd = FD.open(entry.name, os.O_PATH | os.O_NOFOLLOW, dir_fd=dir_fd.fd)
+        info = InodeInfo(store=self.store, fd=fd)
+        info.get_stat()
+        info.get_handle()
+        return info
+
+    def probe_entries(self, dirinfo, entries):
+        """Yield `(entry, info)` for `entries` of `dirinfo`, probed by the syscall pool."""
+        def hinted():
+            for entry in entries:
+                self.hint(entry.inode())
+                yield entry
+        for entry, fut in self.pool.map(partial(self.probe, dirinfo.get_fd()), hinted()):
+            yield entry, fut.result()
+
+    def prepare_sr(self, sr):
+        """Do the syscalls needed by `process_sr` ahead, in a worker thread: stat
+        the target and, if it is a directory to be scanned, read it."""
+        info = sr.target
+        info.get_stat(force=True)
+        if sr.action != SR_CHECK and info.type == 'd':
+            return self.read_dir(info)
+
+    def scan_dir(self, dirinfo, *, dirobj=None, fresh_stat=False, recursive=False, entries=None):
         if D_SCAN: log.debug("Scanning %r", dirinfo)
         seen  = set()
         st_start = dirinfo.get_stat(force=not fresh_stat)
@@ -186,63 +380,67 @@ class Scanner:
             except CrossMount: return
         assert dirobj.type == 'd'
         assert dirinfo.iid
+        if entries is None:
+            entries = self.read_dir(dirinfo)
         with self.db.ensure_transaction():
-            for entry in fdscandir(dirinfo.get_fd()):
-                if entry.name == '.filoco': continue
-                try:
-                    entry.name.encode('utf-8')
-                except UnicodeEncodeError:
-                    log.warning('Invalid UTF-8 name: %s/%s. Skipping.', ascii(frealpath(dirinfo.fd)), ascii(entry.name))
-                    continue
+            # The stored state of the directory, compared with what we read in memory.
+            # Inode columns are those `on_link` needs of the previously linked inode.
+            links = { link.name: link for link in self.db.query(
+                            'select l.rowid, l.name, l.ino, i.iid, i.type, i.fob, i.flv, i.fcv from links l'
+                            ' left join inodes i on i.ino = l.ino where l.parent = ?', dirobj.ino) }
+            to_insert = []
+            to_update = []
+            for entry, info in self.probe_entries(dirinfo, entries):
                 seen.add(entry.name)
-                # Grab an O_PATH file descriptor to guarantee that all the subsequent
-                # operations (fstat, name_to_handle_at, ...) refer to the same inode,
-                # even if the name is replaced.
-                fd = FD.open(entry.name, os.O_PATH | os.O_NOFOLLOW, dir_fd=dirinfo.get_fd().fd)
-                info = InodeInfo(store=self.store, fd=fd)
-
                 obj, created = self.store.find_or_create_inode(info)
-                # self.db.update('inodes', 'parent=? and name=? and ino!=?',
-                #         dirobj.ino, entry.name, obj.ino, name=None, parent=None,
-                #         updated=1)
-                # if self.db.changes(): # A replacement took place
-                #     pass
-                old_obj = self.db.query_first('select * from links join inodes '
-                            ' using (ino) where parent = ? and name = ?',
-                            dirobj.ino, entry.name)
-                if old_obj is None or obj.ino != old_obj.ino:
-                    if old_obj is not None:
-                        self.db.update('links', 'parent=? and name=?',
-                                dirobj.ino, entry.name, ino=obj.ino)
+                link = links.get(entry.name)
+                # A created inode with the linked number means that the number was reused
+                # by a new inode (the old record was just deleted by `find_inode`).
+                if link is None or link.ino != obj.ino or created:
+                    if link is None:
+                        to_insert.append((obj.ino, dirobj.ino, entry.name))
+                    else:
+                        to_update.append((obj.ino, link.rowid))
+                    if link is None or link.iid is None: # new name or a link to a deleted inode
+                        old_obj = None
+                    elif link.ino == obj.ino: # the old record is gone, use what we loaded
+                        old_obj = link
                     else:
-                        self.db.insert('links', ino=obj.ino, parent=dirobj.ino,
-                                    name=entry.name)
+                        old_obj = self.db.query_first('select * from inodes where ino=?', link.ino)
                     if D_MDUPDATE:
-                        log.debug("Linking %s into %s", frealpath(fd),
+                        log.debug("Linking %s into %s", frealpath(info.fd),
                             frealpath(dirinfo.fd))
                     self.on_link(dirinfo, dirobj, entry.name, info, obj, old_obj)
                     #self.db.insert('fslog', event=EVENT_LINK, iid=obj.iid, parent_iid=dirobj.iid,
                         #                        name=entry.name)
                 if recursive and stat.S_ISDIR(info.stat.st_mode):
-                    self.push_scan(SR_SCAN_RECURSIVE, info)
+                    self.push_scan(SR_SCAN_RECURSIVE, info, entry.inode())
             to_del = []
-            for obj in self.db.query('select rowid, name from links where parent=?', dirobj.ino):
-                if obj.name not in seen:
+            for name, link in links.items():
+                if name not in seen:
                     if D_MDUPDATE:
-                        log.debug("Ulinking %s from %s" % (obj.name, frealpath(dirinfo.fd)))
-                    to_del.append((obj['rowid'],))
+                        log.debug("Ulinking %s from %s" % (name, frealpath(dirinfo.fd)))
+                    to_del.append((link.rowid,))
                     #self.db.insert('fslog', event=EVENT_UNLINK, iid=obj.iid, parent_iid=dirobj.iid,
                     #                        name=entry.name)
             if to_del:
                 self.db.executemany('delete from links where rowid=?', to_del)
-            st_end = dirinfo.get_stat(force=True)
-            if stat_tuple(st_start) == stat_tuple(st_end):
-                # No racy changes during scan
-                self.db.update('inodes','ino=?', dirobj.ino, scan_state=SCAN_UP_TO_DATE, **stat_tuple(st_end))
-            else:
-                log.warn("Race condition during directory scan of %r, needs further rescan")
-                self.db.update('inodes','ino=?', dirobj.ino, scan_state=SCAN_NEEDS_RESCAN)
-                # TODO schedule delayed rescan (exp. backoff ideally)
+            if to_update:
+                self.db.executemany('update links set ino=? where rowid=?', to_update)
+            if to_insert:
+                self.db.executemany('insert into links (ino, parent, name) values (?,?,?)', to_insert)
+            self.db.update('inodes','ino=?', dirobj.ino, **self.dir_scan_state(dirinfo, st_start))
+
+    def dir_scan_state(self, dirinfo, st_start):
+        """Return the inode columns to store for a directory read since it was stat'ed as `st_start`."""
+        st_end = dirinfo.get_stat(force=True)
+        if stat_tuple(st_start) == stat_tuple(st_end):
+            # No racy changes during scan
+            return dict(scan_state=SCAN_UP_TO_DATE, **stat_tuple(st_end))
+        else:
+            log.warning("Race condition during directory scan of %r, needs further rescan", dirinfo)
+            # TODO schedule delayed rescan (exp. backoff ideally)
+            return dict(scan_state=SCAN_NEEDS_RESCAN)
 
     def on_link(self, parent_info, parent_obj, name, info, obj, old_obj=None):
         # To create a FLV, we need parent FOB. But it may happen because of race conditions
@@ -263,7 +461,7 @@ class Scanner:
             if not replace and self.db.query_first('select 1 from inodes where iid=? and fob is not null', obj.iid):
                 return
             if D_MDUPDATE: log.debug("Assigning inode %s to FOB (%s, %s, %s)", binhex(obj.iid), binhex(fob_id), binhex(flv_id), binhex(fcv_id))
-            self.db.update('inodes', 'iid=?', obj.iid, fob=fob_id, fcv=fcv_id, flv=flv_id)
+            self.store.update_inode(obj.ino, fob=fob_id, fcv=fcv_id, flv=flv_id)
             obj.fob = fob_id
             obj.flv = flv_id
             obj.fcv = fcv_id
@@ -303,7 +501,7 @@ class Scanner:
                 if Store.LONGNAME_SEPARATOR in name: return
                 new_flv = self.store.create_flv(fob=obj.fob, parent_fob=parent_obj.fob,
                                                 name=logical_name, parent_vers=obj.flv)
-                self.db.update('inodes', 'iid=?', obj.iid, flv=new_flv)
+                self.store.update_inode(obj.ino, flv=new_flv)
                 obj.flv = new_flv
 
     def queue_unscanned(self, action=SR_SCAN):
@@ -317,15 +515,41 @@ class Scanner:
                                     SCAN_UP_TO_DATE):
             self.push_scan(action, InodeInfo.from_db(self.store, row))
 
-    def process_sr(self, sr):
+    def pop_sr(self):
+        sr = self.scan_queue.get_nowait()
+        if D_QUEUE: log.debug('Popped %r', sr)
         if sr.target.fd:
             self.queue_fds -= 1
+        self.sweep.visit(sr.prio)
+        self.hint(sr.prio[1])
+        return sr
+
+    def pop_window(self):
+        """Pop up to a queue depth of requests and yield `(sr, prepared)` for them,
+        where `prepared` is the future of `prepare_sr(sr)` run by the syscall pool."""
+        window = []
+        while len(window) < self.pool.depth and not self.scan_queue.empty():
+            window.append(self.pop_sr())
+        return self.pool.map(self.prepare_sr, window)
+
+    def process_sr(self, sr, prepared=None):
+        """Process a scan request. `prepared` is the future of `prepare_sr(sr)`, if
+        it was run. If it failed, the syscalls are retried and errors handled here."""
+        kw = {}
+        if prepared is not None:
+            try:
+                entries = prepared.result()
+            except (OSError, StaleHandle):
+                pass
+            else:
+                kw['fresh_stat'] = True
+                if sr.action != SR_CHECK: kw['entries'] = entries
         if sr.action == SR_CHECK:
-            self.check(sr.target)
+            self.check(sr.target, **kw)
         elif sr.action == SR_SCAN:
-            self.scan(sr.target)
+            self.scan(sr.target, **kw)
         elif sr.action == SR_SCAN_RECURSIVE:
-            self.scan(sr.target, recursive=True)
+            self.scan(sr.target, recursive=True, **kw)
         else:
             raise NotImplementedError
 
@@ -333,18 +557,20 @@ class Scanner:
         """A coroutine that consumes the scan queue and runs scan() appropriately."""
         log.debug("scan_worker started")
         while True:
-            with self.db.ensure_transaction():
-                for i in range(50000):
+            with self.db.bulk_transaction():
+                done = 0
+                while done < 50000:
                     if self.scan_queue.empty():
                         self.queue_unscanned()
                     if self.scan_queue.empty():
                         break
-                    sr = await self.scan_queue.get()
-                    if D_QUEUE: log.debug('Popped %r', sr)
-                    self.process_sr(sr)
-                    self.total_scanned += 1
-                    if self.total_scanned % 10000 == 0:
-                        log.info("Scanned %d items", self.total_scanned)
+                    # Let the syscall pool prepare a window of requests ahead of us
+                    for sr, prepared in self.pop_window():
+                        self.process_sr(sr, prepared)
+                        self.total_scanned += 1
+                        if self.total_scanned % 10000 == 0:
+                            log.info("Scanned %d items", self.total_scanned)
+                        done += 1
                     # If the queue is long (e.g. during a full rescan), we need to give
                     # the event loop a chance to run.
                 else:
@@ -363,9 +589,13 @@ class Scanner:
         log.debug("init")
         if self.watch_mode == 'fanotify':
             self.init_fanotify()
+        # Resolve known inodes from memory instead of querying the database for each
+        self.store.enable_inode_index()
         # Ensure there is a root record in DB, otherwise recheck would do nothing
         self.store.get_root()
-        if self.init_scan == 'all':
+        if self.initial_import:
+            InitialImport(self).run()
+        elif self.init_scan == 'all':
             #self.db.update('inodes', "type='d' and scan_state=?", SCAN_UP_TO_DATE, scan_state=SCAN_WANT_RESCAN)
             if self.recursive:
                 if self.start_path == Path():
@@ -392,10 +622,208 @@ class Scanner:
                 self.db.execute('pragma cache_spill=OFF')
                 #with self.db.ensure_transaction(): # XXX
                 self.loop.run_until_complete(self.scan_task)
+            self.pool.shutdown()
         else:
             self.loop.run_forever()
 
 
+class InitialImport:
+    """Bulk import of a tree that was never scanned (`scan.py --initial-import`).
+
+    The tree is walked through the scanner's queue and syscall pool, like a
+    recursive scan (see `Scanner.pop_window` and `Scanner.probe_entries`), but the
+    results are only collected into temporary staging tables, in large batches. Inodes,
+    links and the FOBs with their first FLVs and FCVs are then created by a few
+    set-wise statements in one transaction, with the secondary indexes dropped
+    and rebuilt afterwards. The store ends up with the same objects as after
+    a normal first scan, FLVs for extra hard links come after all other syncables."""
+    BATCH = 10000
+    STAGING_SCHEMA = [
+        # One row per directory entry, in the order a recursive scan would link them
+        '''create temp table import_entries (seq integer primary key, parent integer not null, name text not null,
+            ino integer not null, handle_type integer, handle blob, type text, size integer, mtime integer,
+            iid blob, fob blob, flv blob, fcv blob, parent_fob blob)''',
+        # Stat data of scanned directories after the scan
+        'create temp table import_dirs (ino integer primary key, size integer, mtime integer, scan_state integer)',
+        # New syncables in insertion order
+        'create temp table import_syncables (n integer primary key, id blob not null, kind text not null)',
+    ]
+    INDEXED_TABLES = ('inodes', 'links', 'syncables', 'fobs', 'flvs', 'fcvs')
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.store = scanner.store
+        self.db = scanner.db
+        self.batch = []
+        self.dirs = []
+        # Inodes with several links seen so far and links to them other than the first
+        self.multi_linked = set()
+        self.extra_links = []
+        # Queued directories: their FOB (or None) and whether their entries get FOBs.
+        # A directory moved during the walk must not be read twice.
+        self.dir_fobs = {}
+        self.seq = 0
+
+    def run(self):
+        db = self.db
+        if db.query_first("select 1 from inodes where iid != 'ROOT' union all select 1 from links"):
+            raise ValueError("Initial import is only possible in a store that was never scanned")
+        for table in ('import_entries', 'import_dirs', 'import_syncables'):
+            db.execute('drop table if exists temp.%s' % table)
+        for stmt in self.STAGING_SCHEMA: db.execute(stmt)
+        scanner = self.scanner
+        root_row, root_info = self.store.get_root()
+        self.dir_fobs[root_row.ino] = (None, True)
+        # Directories left for a rescan (e.g. because of races) are then scanned
+        # normally by the scan worker this starts
+        scanner.push_scan(SR_SCAN_RECURSIVE, root_info)
+        while not scanner.scan_queue.empty():
+            for sr, prepared in scanner.pop_window():
+                self.import_dir(sr.target, prepared)
+                scanner.total_scanned += 1
+                if scanner.total_scanned % 10000 == 0:
+                    log.info("Scanned %d directories, %d entries", scanner.total_scanned, self.seq)
+        self.flush()
+        log.info("Read %d entries, loading", self.seq)
+        self.drop_duplicates()
+        with db.bulk_transaction():
+            self.load()
+            self.link_extra()
+        for table in ('import_entries', 'import_dirs', 'import_syncables'):
+            db.execute('drop table temp.%s' % table)
+
+    def import_dir(self, dirinfo, prepared):
+        """Collect the entries of a directory (see `Scanner.scan_dir`) and queue its
+        subdirectories. `prepared` is the future of `Scanner.prepare_sr`."""
+        dir_ino = dirinfo.get_ino()
+        dir_fob, with_fobs = self.dir_fobs[dir_ino]
+        try:
+            entries = prepared.result()
+        except (OSError, StaleHandle):
+            # Gone or changed meanwhile, leave it to the rescan
+            self.dirs.append((dir_ino, None, None, SCAN_NEEDS_RESCAN))
+            return
+        st_start = dirinfo.stat
+        for entry, info in self.scanner.probe_entries(dirinfo, entries):
+            st = info.stat
+            if st.st_nlink > 1 and info.type != 'd':
+                if st.st_ino in self.multi_linked:
+                    self.extra_links.append((dir_ino, entry.name, st.st_ino))
+                    continue
+                self.multi_linked.add(st.st_ino)
+            handle = info.get_handle()
+            self.seq += 1
+            fob = flv = fcv = None
+            # As in `Scanner.on_link_to_fob`, entries of FOB-less directories and longnames get no FOB
+            if with_fobs and info.type in ('d', 'r'):
+                if Store.LONGNAME_SEPARATOR in entry.name:
+                    log.warning("Longname without FOB: %s/%s", binhex(dir_fob), entry.name)
+                else:
+                    fob, flv = gen_uuid(), gen_uuid()
+                    if info.type == 'r': fcv = gen_uuid()
+            self.batch.append((self.seq, dir_ino, entry.name, st.st_ino, handle.type, handle.handle, info.type,
+                               st.st_size, st.st_mtime, gen_uuid(), fob, flv, fcv, dir_fob))
+            if len(self.batch) >= self.BATCH: self.flush()
+            if info.type == 'd' and st.st_ino not in self.dir_fobs:
+                self.dir_fobs[st.st_ino] = (fob, fob is not None)
+                self.scanner.push_scan(SR_SCAN_RECURSIVE, info)
+        state = self.scanner.dir_scan_state(dirinfo, st_start)
+        self.dirs.append((dir_ino, state.get('size'), state.get('mtime'), state['scan_state']))
+
+    def flush(self):
+        with self.db:
+            self.db.executemany('insert into temp.import_entries values (%s)' % ','.join(repeat('?', 14)), self.batch)
+            self.db.executemany('insert into temp.import_dirs values (?,?,?,?)', self.dirs)
+        self.batch = []
+        self.dirs = []
+
+    def drop_duplicates(self):
+        """Keep only the first entry of each inode that was read more than once.
+
+        This happens when something is moved (or an inode number reused) during
+        the walk. The links are left to a rescan of all the directories involved,
+        instead of failing on the unique indexes at the end of the load."""
+        db = self.db
+        first = {}
+        drop, parents = [], set()
+        with db:
+            for row in list(db.query('select seq, parent, name, ino from temp.import_entries where ino in'
+                                     ' (select ino from temp.import_entries group by ino having count(*) > 1)'
+                                     ' order by ino, seq')):
+                parents.add(row.parent)
+                if row.ino not in first:
+                    first[row.ino] = row
+                    continue
+                orig = first[row.ino]
+                log.warning("Inode %d found both as %r in directory %d and as %r in directory %d"
+                            " (changed during the import), rescanning", row.ino, orig.name, orig.parent, row.name, row.parent)
+                drop.append((row.seq,))
+            db.executemany('delete from temp.import_entries where seq=?', drop)
+            db.executemany('insert or replace into temp.import_dirs values (?, null, null, ?)',
+                           ( (ino, SCAN_NEEDS_RESCAN) for ino in parents ))
+
+    def load(self):
+        db = self.db
+        store = self.store
+        indexes = list(db.query("select name, sql from sqlite_master where type='index' and sql is not null"
+                                " and tbl_name in (%s)" % ','.join(repeat('?', len(self.INDEXED_TABLES))),
+                                *self.INDEXED_TABLES, _assoc=False))
+        for name, sql in indexes:
+            db.execute('drop index %s' % name)
+        log.info("Creating inodes and links")
+        root = db.query_first("select d.* from temp.import_dirs d join inodes i on i.ino=d.ino where i.iid='ROOT'")
+        if root.scan_state == SCAN_UP_TO_DATE:
+            db.update('inodes', 'ino=?', root.ino, scan_state=root.scan_state, size=root.size, mtime=root.mtime)
+        else:
+            db.update('inodes', 'ino=?', root.ino, scan_state=root.scan_state)
+        db.execute('insert into inodes (ino, handle_type, handle, iid, type, scan_state, size, mtime, btime, fob, flv, fcv)'
+                   ' select e.ino, e.handle_type, e.handle, e.iid, e.type, coalesce(d.scan_state, ?),'
+                   ' coalesce(d.size, e.size), coalesce(d.mtime, e.mtime), e.mtime, e.fob, e.flv, e.fcv'
+                   ' from temp.import_entries e left join temp.import_dirs d on d.ino=e.ino order by e.seq',
+                   SCAN_UP_TO_DATE)
+        db.execute('insert into links (parent, name, ino) select parent, name, ino from temp.import_entries order by seq')
+        db.executemany('insert into links (parent, name, ino) values (?,?,?)', self.extra_links)
+
+        log.info("Creating syncables")
+        # Each FOB is followed by its FLV and FCV, like `Store.create_fob` adds them
+        db.execute('insert into temp.import_syncables (id, kind) select id, kind from'
+                   " (select seq, 0 as k, fob as id, 'fob' as kind from temp.import_entries where fob is not null"
+                   "  union all select seq, 1, flv, 'flv' from temp.import_entries where flv is not null"
+                   "  union all select seq, 2, fcv, 'fcv' from temp.import_entries where fcv is not null)"
+                   ' order by seq, k')
+        cols, values = ['id', 'kind', 'origin_idx', 'created'], ['id', 'kind', '0', ':now']
+        if store.sync_mode == 'serial':
+            last_seq = db.query_first('select coalesce(max(serial), 0) from syncables where origin_idx=0', _assoc=False)[0]
+            cols.append('serial'); values.append(':last_seq + n')
+        elif store.sync_mode == 'synctree':
+            store.synctree.register_functions()
+            cols.append('tree_key'); values.append('synctree_pos(id)')
+        db.execute('insert into syncables ({cols}) select {values} from temp.import_syncables order by n'
+                   .format(cols=', '.join(cols), values=', '.join(values)),
+                   now=time.time(), **({'last_seq': last_seq} if store.sync_mode == 'serial' else {}))
+        db.execute('insert into fobs (id, type) select fob, type from temp.import_entries where fob is not null order by seq')
+        db.execute("insert into flvs (id, fob, parent_fob, name, parent_vers) select flv, fob, parent_fob, name, ''"
+                   ' from temp.import_entries where flv is not null order by seq')
+        db.execute("insert into fcvs (id, fob, content_hash, parent_vers, _is_head) select fcv, fob, null, x'', 1"
+                   ' from temp.import_entries where fcv is not null order by seq')
+
+        log.info("Rebuilding indexes")
+        for name, sql in indexes:
+            db.execute(sql)
+        db.after_commit('inode_index', store.reload_inode_index)
+        if store.sync_mode == 'synctree':
+            store.synctree.rebuild()
+        elif store.sync_mode == 'iblt':
+            store.iblt.added( row[0] for row in db.query('select id from temp.import_syncables order by n', _assoc=False) )
+
+    def link_extra(self):
+        """Process links to already imported inodes like a normal scan does."""
+        for parent, name, ino in self.extra_links:
+            parent_obj = self.db.query_first('select * from inodes where ino=?', parent)
+            obj = self.db.query_first('select * from inodes where ino=?', ino)
+            info = InodeInfo.from_db(self.store, obj)
+            self.scanner.on_link(None, parent_obj, name, info, obj)
+
 
 if __name__ == '__main__':
     import argparse
@@ -409,6 +837,17 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--recursive', default=False, action='store_true',
                         help="Perform a full recursive scan instead of just rechecking directory mtimes. "
                              "Useful if you suspect metadata in filoco database to be incorrect.")
+    parser.add_argument('-i', '--initial-import', default=False, action='store_true',
+                        help="Import a tree that was never scanned in bulk. Much faster than a normal"
+                             " first scan of huge trees.")
+    parser.add_argument('-j', '--workers', type=int, default=Scanner.WORKERS,
+                        help="Number of threads doing syscalls (readdir, stat, ...) for the scan,"
+                             " 0 to do them in the main thread (default %(default)s)")
+    parser.add_argument('-q', '--queue-depth', type=int, default=Scanner.QUEUE_DEPTH,
+                        help="How many syscalls may be in flight ahead of the database writer."
+                             " Raise it to saturate fast SSDs and disk arrays (default %(default)s)")
+    parser.add_argument('--no-readahead', dest='readahead', default=True, action='store_false',
+                        help="Do not issue readahead hints for inode tables (ext2/3/4 only)")
     parser.add_argument('dir')
     opts = parser.parse_args()
     log.debug(opts)
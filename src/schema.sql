@@ -89,6 +89,16 @@ create table synctree (
 );
 # endif
 
+#if sync_mode == 'iblt'
+-- Cells of the IBLTs used for set reconciliation, see SyncIBLT in store.py
+create table iblt (
+    cell integer primary key,
+    count integer not null,
+    xor blob not null,
+    chxor blob not null
+);
+#endif
+
 create table fobs (
     id blob unique not null references syncables(id),
     type text,
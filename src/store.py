@@ -6,7 +6,7 @@ SQLite database.
 """
 
 
-import sys, os
+import sys, os, fcntl
 from utils import *
 from butter.fhandle import *
 from pathlib import Path
@@ -46,12 +46,82 @@ SCAN_WANT_RESCAN = 2
 SCAN_UP_TO_DATE = 100
 
 META_DIR = '.filoco'
+SYNC_MODES = ('serial', 'synctree', 'iblt')
+
+def parse_scope(text):
+    """Parse a list of world-relative paths, one per line, into a scope.
+
+    A scope is a sorted list of normalized paths, or None, which stands for
+    the whole world."""
+    paths = set()
+    for line in text.splitlines():
+        path = '/'.join( part for part in line.strip().split('/') if part not in ('', '.') )
+        if not path: return None
+        paths.add(path)
+    if not paths: return None
+    # Paths within other listed paths are redundant
+    return sorted( path for path in paths
+                    if not any( path.startswith(other + '/') for other in paths ) )
+
+def intersect_scopes(a, b):
+    """Return the scope of everything that is in both scopes `a` and `b`."""
+    if a is None: return b
+    if b is None: return a
+    ret = set()
+    for x in a:
+        for y in b:
+            xp, yp = x.split('/'), y.split('/')
+            if xp[:len(yp)] == yp: ret.add(x)
+            elif yp[:len(xp)] == xp: ret.add(y)
+    return sorted(ret)
+
+def select_scope(db, scope):
+    """Select the syncables within `scope` into the temporary table `scope_syncables`.
+
+    A scope path is resolved component by component using head FLVs. FOBs
+    that have (in any version) been located below one of the resolved FOBs
+    are in the scope, and so are the FOBs on the way to them, as a replica
+    needs them to place the subtree. The selected syncables are these FOBs
+    and all their FLVs and FCVs. Call from within a transaction if the
+    result should be consistent with other reads."""
+    for table in ('scope_roots', 'scope_fobs'):
+        db.execute('create temp table if not exists %s (id blob primary key)' % table)
+        db.execute('delete from temp.%s' % table)
+    db.execute('create temp table if not exists scope_syncables (insert_order integer primary key)')
+    db.execute('delete from temp.scope_syncables')
+    roots, ancestors = [], []
+    for path in scope or ():
+        fobs = None
+        for name in path.split('/'):
+            if fobs is None:
+                rows = db.query('select distinct fob from flvs where parent_fob is null and name=? and _is_head=1',
+                                name, _assoc=False)
+            else:
+                ancestors += fobs
+                rows = db.query('select distinct fob from flvs where parent_fob in (%s) and name=? and _is_head=1'
+                                % ','.join(repeat('?', len(fobs))), *fobs, name, _assoc=False)
+            fobs = [ row[0] for row in rows ]
+            if not fobs: break
+        roots += fobs
+    db.executemany('insert or ignore into temp.scope_roots values (?)', ( (id,) for id in roots ))
+    db.execute('insert or ignore into temp.scope_fobs with recursive sub(id) as'
+               ' (select id from temp.scope_roots union select v.fob from flvs v join sub on v.parent_fob=sub.id)'
+               ' select id from sub')
+    db.executemany('insert or ignore into temp.scope_fobs values (?)', ( (id,) for id in ancestors ))
+    db.execute('insert or ignore into temp.scope_syncables'
+               ' select s.insert_order from temp.scope_fobs f join syncables s on s.id=f.id'
+               ' union all select s.insert_order from temp.scope_fobs f join flvs v on v.fob=f.id join syncables s on s.id=v.id'
+               ' union all select s.insert_order from temp.scope_fobs f join fcvs v on v.fob=f.id join syncables s on s.id=v.id')
 
 class StoreNotFound(FileNotFoundError):
     def __init__(self, path):
         if isinstance(path, int): path = frealpath(path)
         super().__init__("'%s' is not (in) a Filoco repository." % path)
 
+class StoreInUse(Exception):
+    def __init__(self, path):
+        super().__init__("'%s' is in use by another process." % path)
+
 
 class Object:
     def __init__(self, store, oid=None):
@@ -59,20 +129,168 @@ class Object:
         self.oid = oid
 
 import hashlib, codecs
+from array import array
+from bisect import bisect_left, bisect_right
+
+class MemSyncTree(DbCache):
+    """An in-memory copy of the `synctree` table.
+
+    Nodes are kept in three compact parallel arrays sorted by position: positions
+    in an array of 64-bit ints and xors/chxors as fixed-size records in two
+    bytearrays. All positions of one level (or of the children of one node)
+    form a contiguous range, so they can be found by bisection.
+
+    The owning SyncTree applies its committed changes (see DbCache)."""
+
+    def __init__(self, db, id_bytes):
+        super().__init__(db)
+        self.id_bytes = id_bytes
+        self.pos = array('Q')
+        self.xors = bytearray()
+        self.chxors = bytearray()
+
+    def load(self, query='select pos, xor, chxor from synctree order by pos'):
+        """Load nodes returned by `query` (as (pos, xor, chxor), sorted by position)."""
+        pos, xors, chxors = array('Q'), bytearray(), bytearray()
+        for p, xor, chxor in self.db.query(query, _assoc=False):
+            pos.append(p)
+            xors += xor
+            chxors += chxor
+        self.pos, self.xors, self.chxors = pos, xors, chxors
+        self.loaded()
+
+    def __len__(self):
+        return len(self.pos)
+
+    def _node(self, idx):
+        start = idx * self.id_bytes
+        end = start + self.id_bytes
+        return bytes(self.xors[start:end]), bytes(self.chxors[start:end])
+
+    def get(self, pos):
+        """Return (xor, chxor) of a node or None if it is empty."""
+        idx = bisect_left(self.pos, pos)
+        if idx < len(self.pos) and self.pos[idx] == pos:
+            return self._node(idx)
+        return None
+
+    def get_many(self, positions):
+        """Return a dict {pos: (xor, chxor)} of all non-empty nodes among `positions`."""
+        ret = {}
+        for pos in positions:
+            node = self.get(pos)
+            if node is not None: ret[pos] = node
+        return ret
+
+    def get_range(self, first, last):
+        """Return a dict {pos: (xor, chxor)} of all non-empty nodes between `first` and `last` inclusive."""
+        lo = bisect_left(self.pos, first)
+        hi = bisect_right(self.pos, last, lo)
+        return { self.pos[idx]: self._node(idx) for idx in range(lo, hi) }
+
+    def apply(self, deltas):
+        """Apply a dict {pos: (xor_delta, chxor_delta)} of int deltas."""
+        nb = self.id_bytes
+        for pos, (xor_delta, chxor_delta) in sorted(deltas.items()):
+            if not (xor_delta or chxor_delta): continue
+            idx = bisect_left(self.pos, pos)
+            start = idx * nb
+            if idx < len(self.pos) and self.pos[idx] == pos:
+                xor = int.from_bytes(self.xors[start:start+nb], 'big') ^ xor_delta
+                chxor = int.from_bytes(self.chxors[start:start+nb], 'big') ^ chxor_delta
+                if not xor:
+                    # Same rule as for the database: zero nodes are deleted
+                    del self.pos[idx]
+                    del self.xors[start:start+nb]
+                    del self.chxors[start:start+nb]
+                else:
+                    self.xors[start:start+nb] = xor.to_bytes(nb, 'big')
+                    self.chxors[start:start+nb] = chxor.to_bytes(nb, 'big')
+            elif xor_delta:
+                self.pos.insert(idx, pos)
+                self.xors[start:start] = xor_delta.to_bytes(nb, 'big')
+                self.chxors[start:start] = chxor_delta.to_bytes(nb, 'big')
+
 class SyncTree:
     #TODO: Split logic and database handling
     POS_BITS = 48
     ID_BITS = 128
     ID_BYTES = ID_BITS//8
     ZERO = b'\0' * ID_BYTES
-    LEAF = 1 << (POS_BITS-1)
+    ZERO_SQL = 'zeroblob(%d)' % ID_BYTES
     POS_SALT = b'filoco-pos-'
     CHK_SALT = b'filoco-chk-'
-    BITS_PER_LEVEL = 1
-    ARITY = 1 << BITS_PER_LEVEL
-    LEVELS = POS_BITS // BITS_PER_LEVEL
-    def __init__(self, db):
+    # Maximum number of positions queried at once (SQLite's limit on bound
+    # parameters is 999 in older versions).
+    XORS_CHUNK = 500
+    def __init__(self, db, bits_per_level=None):
         self.db = db
+        # Stores created before the arity became configurable have no explicit
+        # setting. They use a binary tree whose positions only contain 24 bits
+        # of the hash, so we must keep computing positions the same way for them.
+        self.legacy = bits_per_level is None
+        if self.legacy: bits_per_level = 1
+        if bits_per_level < 1 or self.POS_BITS % bits_per_level:
+            raise ValueError("Bits per synctree level must divide %d" % self.POS_BITS)
+        self.BITS_PER_LEVEL = bits_per_level
+        self.ARITY = 1 << bits_per_level
+        self.LEVELS = self.POS_BITS // bits_per_level
+        # Every position has a marker bit above its key prefix, all positions
+        # of level L are thus in [1 << L*BITS_PER_LEVEL, 2 << L*BITS_PER_LEVEL).
+        self.LEAF = 1 << ((self.LEVELS - 1) * bits_per_level)
+        self.mem = None
+
+    def enable_memtree(self):
+        """Keep an in-memory copy of the synctree (see MemSyncTree)."""
+        if self.mem is None:
+            self.mem = MemSyncTree(self.db, self.ID_BYTES)
+            self.mem.load()
+
+    def refresh_memtree(self):
+        """Reload the in-memory synctree (if enabled) when another connection changed the database.
+
+        Call before a series of reads."""
+        if self.mem is not None and self.mem.is_stale():
+            log.debug("Synctree changed by another connection, reloading")
+            self.mem.load()
+
+    def _reload_memtree(self):
+        if self.mem is not None:
+            self.mem.load()
+
+    def get_xors(self, positions):
+        """Return a dict {pos: (xor, chxor)} of all non-empty nodes among `positions`."""
+        if self.mem is not None:
+            return self.mem.get_many(positions)
+        # TODO: is this better than several queries that can be precompiled?
+        ret = {}
+        for i in range(0, len(positions), self.XORS_CHUNK):
+            chunk = positions[i:i + self.XORS_CHUNK]
+            for row in self.db.query('select pos, xor, chxor from synctree where pos in (%s)'
+                                        % ','.join(repeat('?', len(chunk))), *chunk):
+                ret[row['pos']] = (row['xor'], row['chxor'])
+        return ret
+
+    def get_level(self, level):
+        """Return a dict {pos: (xor, chxor)} of all non-empty nodes of a level."""
+        return self.get_range(*self.level_range(level))
+
+    def get_children(self, pos):
+        """Return a dict {pos: (xor, chxor)} of all non-empty children of a node."""
+        first = pos << self.BITS_PER_LEVEL
+        return self.get_range(first, first + self.ARITY - 1)
+
+    def get_range(self, first, last):
+        """Return a dict {pos: (xor, chxor)} of all non-empty nodes with positions between `first` and `last`."""
+        if self.mem is not None:
+            return self.mem.get_range(first, last)
+        return { row[0]: (row[1], row[2]) for row in self.db.query(
+                    'select pos, xor, chxor from synctree where pos between ? and ?', first, last, _assoc=False) }
+
+    @property
+    def layout(self):
+        """A description of the tree shape, which must be the same for all stores in a world."""
+        return [self.BITS_PER_LEVEL, self.legacy]
 
     def add(self, id, kind, **kw):
         with self.db.ensure_transaction():
@@ -80,38 +298,165 @@ class SyncTree:
             if self.db.changes():
                 self._update_synctree(id)
 
+    def add_many(self, rows):
+        """Add syncables given as dicts with keys id, kind, origin_idx and created.
+
+        None of the IDs may be present yet. Synctree updates are deferred until commit."""
+        with self.db.bulk_transaction():
+            self.db.executemany('insert into syncables (id, kind, origin_idx, created, tree_key) values (?,?,?,?,?)',
+                                ( (row['id'], row['kind'], row['origin_idx'], row['created'], self.hash_pos(row['id']))
+                                  for row in rows ))
+            self.added( row['id'] for row in rows )
+
+    def added(self, ids):
+        """Update the synctree for syncables with `ids` the caller has inserted
+        into `syncables` itself (with tree keys, see `register_functions`).
+
+        Call from within a bulk transaction."""
+        for id in ids:
+            self._defer_update(id)
+
     def has(self, id):
         return bool(self.db.query_first('select 1 from syncables where id=?', id))
 
+    def level_range(self, level):
+        """Return the first and the last position of a given level."""
+        first = 1 << (level * self.BITS_PER_LEVEL)
+        return first, 2*first - 1
+
+    def pos_level(self, pos):
+        """Return the level of a given position."""
+        return (pos.bit_length() - 1) // self.BITS_PER_LEVEL
+
     def subtree_key_range(self, pos):
         left = right = pos
         while not left & self.LEAF:
-            left <<= 1
-            right = (right << 1) + 1
+            left <<= self.BITS_PER_LEVEL
+            right = (right << self.BITS_PER_LEVEL) | (self.ARITY - 1)
         return left, right
 
-    @classmethod
-    def hash_pos(cls, id):
-        return int(hashlib.md5(cls.POS_SALT + id).hexdigest()[:cls.POS_BITS//8], 16) | cls.LEAF
+    def hash_pos(self, id):
+        digest = hashlib.md5(self.POS_SALT + id).hexdigest()
+        if self.legacy:
+            return int(digest[:self.POS_BITS//8], 16) | self.LEAF
+        else:
+            return int(digest[:self.POS_BITS//4], 16) & (self.LEAF - 1) | self.LEAF
     @classmethod
     def hash_chk(cls, id):
         return hashlib.md5(cls.CHK_SALT + id).digest()
 
+    def register_functions(self):
+        """Make `synctree_pos(id)` and `synctree_chk(id)` available in SQL."""
+        self.db.connection.createscalarfunction('synctree_pos', self.hash_pos, 1)
+        self.db.connection.createscalarfunction('synctree_chk', self.hash_chk, 1)
+
+    def _compute_tree(self, where=''):
+        """Compute the whole synctree from `syncables` into `temp.synctree_new`.
+
+        Syncables are read once, sorted by tree key, to compute the leaves. Each
+        level is then aggregated from the level below it, so the work is linear in
+        the number of nodes. Zero nodes are kept, they are needed to compute
+        their parents correctly. `where` can restrict the syncables included."""
+        self.db.execute('drop table if exists temp.synctree_new')
+        self.db.execute('create temp table synctree_new (pos integer primary key, xor blob, chxor blob)')
+        self.db.execute('insert into temp.synctree_new select tree_key, binxor_agg(id), binxor_agg(synctree_chk(id))'
+                        ' from syncables %s group by tree_key order by tree_key' % where)
+        for level in reversed(range(self.LEVELS - 1)):
+            child_first, child_last = self.level_range(level + 1)
+            self.db.execute('insert into temp.synctree_new select pos >> {bits}, binxor_agg(xor), binxor_agg(chxor)'
+                            ' from temp.synctree_new where pos between ? and ? group by pos >> {bits}'
+                            .format(bits=self.BITS_PER_LEVEL), child_first, child_last)
+
+    def rebuild(self):
+        """Recompute tree keys of all syncables and the whole synctree from scratch.
+
+        Used after crashes, large imports or when changing the tree layout."""
+        with self.db.ensure_transaction():
+            self.register_functions()
+            self.db.execute('update syncables set tree_key=synctree_pos(id) where tree_key != synctree_pos(id)')
+            self._compute_tree()
+            self.db.execute('delete from synctree')
+            self.db.execute('insert into synctree select * from temp.synctree_new where xor != %s' % self.ZERO_SQL)
+            self.db.execute('drop table temp.synctree_new')
+            self.db.after_commit('memtree', self._reload_memtree)
+
+    def verify(self):
+        """Check the synctree against `syncables` without modifying anything.
+
+        Return a tuple (number of syncables with a wrong tree key, list of
+        mismatched positions). A position is mismatched if it is missing,
+        superfluous or has wrong xors."""
+        with self.db.ensure_transaction():
+            self.register_functions()
+            bad_keys = self.db.query_first('select count(*) from syncables where tree_key != synctree_pos(id)',
+                                            _assoc=False)[0]
+            self._compute_tree()
+            bad_pos = [ row[0] for row in self.db.query(
+                'select n.pos from temp.synctree_new n left join synctree o on o.pos=n.pos'
+                ' where n.xor != {zero} and (o.pos is null or o.xor != n.xor or o.chxor != n.chxor)'
+                ' union select o.pos from synctree o left join temp.synctree_new n on n.pos=o.pos'
+                ' where n.pos is null or n.xor = {zero} order by 1'.format(zero=self.ZERO_SQL), _assoc=False) ]
+            self.db.execute('drop table temp.synctree_new')
+        return bad_keys, bad_pos
+
+    def level_of(self, pos):
+        """Return the level of a position."""
+        return (pos.bit_length() - 1) // self.BITS_PER_LEVEL
+
     def _update_synctree(self, id):
         """Update synctree after adding or removing a syncable with given id.
         (as we are xorring, the update is the same for adding and removing)
 
+        Inside a bulk transaction (or when the in-memory synctree is enabled),
+        the update is only recorded in memory and all touched positions are
+        written once by `flush` before commit.
+
         Call from within a transaction!"""
 
+        if self.db.trans_local.get('bulk') or self.mem is not None:
+            self._defer_update(id)
+            return
         pos = self.hash_pos(id)
         chk = self.hash_chk(id)
         while pos:
             self.db.execute('insert or ignore into synctree values (?,?,?)', pos, id, chk)
             if not self.db.changes():
                 self.db.execute('update synctree set xor=binxor(xor,?), chxor=binxor(chxor,?) where pos=?', id, chk, pos)
-                self.db.execute('delete from synctree where pos=? and xor=zeroblob(%d)'%(self.ID_BITS//8), pos)
+                self.db.execute('delete from synctree where pos=? and xor=%s' % self.ZERO_SQL, pos)
+            pos >>= self.BITS_PER_LEVEL
+
+    def _defer_update(self, id):
+        deltas = self.db.trans_local.get('synctree_deltas')
+        if deltas is None:
+            deltas = self.db.trans_local.synctree_deltas = {}
+            self.db.before_commit('synctree', self.flush)
+        pos = self.hash_pos(id)
+        # XORs of 128-bit ints are much cheaper than of byte strings
+        id_int = int.from_bytes(id, 'big')
+        chk_int = int.from_bytes(self.hash_chk(id), 'big')
+        while pos:
+            xor, chxor = deltas.get(pos, (0, 0))
+            deltas[pos] = (xor ^ id_int, chxor ^ chk_int)
             pos >>= self.BITS_PER_LEVEL
 
+    def flush(self):
+        """Write synctree updates deferred by the current bulk transaction.
+
+        Each touched position is written once, no matter how many syncables
+        below it were added. Called automatically before commit."""
+        deltas = self.db.trans_local.pop('synctree_deltas', None)
+        if not deltas: return
+        if self.mem is not None:
+            self.db.after_commit(('memtree', id(deltas)), lambda: self.mem.apply(deltas))
+        rows = [ (xor.to_bytes(self.ID_BYTES, 'big'), chxor.to_bytes(self.ID_BYTES, 'big'), pos)
+                    for pos, (xor, chxor) in sorted(deltas.items()) if xor or chxor ]
+        zero = self.ZERO_SQL
+        self.db.executemany('insert or ignore into synctree values (?,%s,%s)' % (zero, zero),
+                                ( (pos,) for xor, chxor, pos in rows ))
+        self.db.executemany('update synctree set xor=binxor(xor,?), chxor=binxor(chxor,?) where pos=?', rows)
+        self.db.executemany('delete from synctree where pos=? and xor=%s' % zero,
+                                ( (pos,) for xor, chxor, pos in rows ))
+
 
     # def create_trigger(self):
     #     for (event, rec) in (('insert', 'new'), ('delete', 'old')):
@@ -128,6 +473,296 @@ class SyncTree:
     #         #print('\n'.join(l))
     #         self.db.execute('\n'.join(l))
 
+class ScopedSyncTree(SyncTree):
+    """A read-only synctree of the syncables in `temp.scope_syncables` (see `Store.stage_scope`).
+
+    It is computed at once from `syncables` and kept in memory only, so it
+    does not reflect later changes. mdsync uses it to reconcile a subset of
+    the world with a store that wants only some subtrees."""
+    def __init__(self, synctree):
+        super().__init__(synctree.db, None if synctree.legacy else synctree.BITS_PER_LEVEL)
+        db = self.db
+        with db.ensure_transaction():
+            self.register_functions()
+            self._compute_tree('where insert_order in (select insert_order from temp.scope_syncables)')
+            self.mem = MemSyncTree(db, self.ID_BYTES)
+            self.mem.load('select pos, xor, chxor from temp.synctree_new where xor != %s order by pos' % self.ZERO_SQL)
+            db.execute('drop table temp.synctree_new')
+            self.ids = { row[0] for row in db.query('select s.id from temp.scope_syncables x'
+                                                    ' join syncables s on s.insert_order=x.insert_order', _assoc=False) }
+
+    def refresh_memtree(self):
+        pass
+
+    def has(self, id):
+        return id in self.ids
+
+class SyncIBLT:
+    """Invertible Bloom lookup tables over syncable IDs for set reconciliation.
+
+    The `iblt` table holds a main IBLT and a strata estimator. The estimator
+    consists of STRATA small IBLTs, an ID goes to stratum i if its hash has
+    i trailing zero bits. Each IBLT is split into HASHES subtables with a
+    power-of-two number of cells and every ID is added to exactly one cell of
+    each subtable. A subtable of 2**n cells can thus be folded to any smaller
+    power of two by adding cell c to cell c mod 2**m, which lets us send a main
+    IBLT proportional to the estimated difference.
+
+    Cells are kept as three parallel lists (counts, ID xors, hash xors), which
+    is what all the methods taking or returning `cells` work with."""
+    ID_BYTES = 16
+    HASH_BYTES = 8
+    HASHES = 3
+    MAIN_BITS = 14 # 3 * 2**14 cells, enough to decode about 30000 differences
+    STRATA = 16
+    STRATUM_BITS = 4
+    # Numbering of cells in the `iblt` table: main IBLT first, then the strata
+    STRATA_BASE = HASHES << MAIN_BITS
+    STRATA_CELLS = STRATA * HASHES << STRATUM_BITS
+    CELL_SALT = b'filoco-iblt-'
+    CHK_SALT = b'filoco-chk-'
+    ZERO_SQL = 'zeroblob(%d)' % ID_BYTES
+    HASH_ZERO_SQL = 'zeroblob(%d)' % HASH_BYTES
+
+    def __init__(self, db):
+        self.db = db
+        # Loaded and folded tables (see `_cached`)
+        self._cache = DbCache(db)
+        self._cached_values = {}
+
+    @property
+    def layout(self):
+        """A description of the table shape, which must be the same for all stores in a world."""
+        return [self.HASHES, self.MAIN_BITS, self.STRATA, self.STRATUM_BITS]
+
+    def add(self, id, kind, **kw):
+        with self.db.ensure_transaction():
+            self.db.insert('syncables', _on_conflict='ignore', id=id, kind=kind, **kw)
+            if self.db.changes():
+                self._defer_update(id)
+
+    def add_many(self, rows):
+        """Add syncables given as dicts with keys id, kind, origin_idx and created.
+
+        None of the IDs may be present yet."""
+        with self.db.ensure_transaction():
+            self.db.executemany('insert into syncables (id, kind, origin_idx, created) values (?,?,?,?)',
+                                ( (row['id'], row['kind'], row['origin_idx'], row['created']) for row in rows ))
+            self.added( row['id'] for row in rows )
+
+    def added(self, ids):
+        """Update the IBLTs for syncables with `ids` the caller has inserted into `syncables` itself."""
+        for id in ids:
+            self._defer_update(id)
+
+    def has(self, id):
+        return bool(self.db.query_first('select 1 from syncables where id=?', id))
+
+    @classmethod
+    def hash_indices(cls, id):
+        """Return a list of per-subtable indices (before reduction to subtable size) and the stratum of an ID."""
+        digest = hashlib.md5(cls.CELL_SALT + id).digest()
+        indices = [ int.from_bytes(digest[4*i:4*i+4], 'big') for i in range(cls.HASHES) ]
+        strat_hash = int.from_bytes(digest[12:16], 'big')
+        stratum = min((strat_hash & -strat_hash).bit_length() - 1, cls.STRATA - 1) if strat_hash else cls.STRATA - 1
+        return indices, stratum
+
+    @classmethod
+    def hash_chk(cls, id):
+        return int.from_bytes(hashlib.md5(cls.CHK_SALT + id).digest()[:cls.HASH_BYTES], 'big')
+
+    @classmethod
+    def cells_of(cls, indices, bits):
+        """Return the cells of an IBLT with subtables of 2**bits cells given `hash_indices`."""
+        mask = (1 << bits) - 1
+        return [ (i << bits) | (idx & mask) for i, idx in enumerate(indices) ]
+
+    @classmethod
+    def add_to_cells(cls, cells, id):
+        """Add an ID to a dict {cell: (count, xor, chxor)} covering the main IBLT and the strata."""
+        indices, stratum = cls.hash_indices(id)
+        id_int = int.from_bytes(id, 'big')
+        chk_int = cls.hash_chk(id)
+        touched = cls.cells_of(indices, cls.MAIN_BITS)
+        strat_base = cls.STRATA_BASE + (stratum * cls.HASHES << cls.STRATUM_BITS)
+        touched += [ strat_base + cell for cell in cls.cells_of(indices, cls.STRATUM_BITS) ]
+        for cell in touched:
+            count, xor, chxor = cells.get(cell, (0, 0, 0))
+            cells[cell] = (count + 1, xor ^ id_int, chxor ^ chk_int)
+
+    def _defer_update(self, id):
+        """Record the addition of an ID, all touched cells are written once by `flush` before commit."""
+        deltas = self.db.trans_local.get('iblt_deltas')
+        if deltas is None:
+            deltas = self.db.trans_local.iblt_deltas = {}
+            self.db.before_commit('iblt', self.flush)
+        self.add_to_cells(deltas, id)
+
+    def flush(self):
+        """Write IBLT updates deferred by the current transaction. Called automatically before commit."""
+        deltas = self.db.trans_local.pop('iblt_deltas', None)
+        if not deltas: return
+        self._cache.invalidate()
+        rows = [ (count, xor.to_bytes(self.ID_BYTES, 'big'), chxor.to_bytes(self.HASH_BYTES, 'big'), cell)
+                    for cell, (count, xor, chxor) in sorted(deltas.items()) ]
+        self.db.executemany('insert or ignore into iblt values (?,0,%s,%s)' % (self.ZERO_SQL, self.HASH_ZERO_SQL),
+                                ( (row[3],) for row in rows ))
+        self.db.executemany('update iblt set count=count+?, xor=binxor(xor,?), chxor=binxor(chxor,?) where cell=?', rows)
+
+    def rebuild(self):
+        """Recompute the whole table from `syncables`."""
+        with self.db.ensure_transaction():
+            self.db.trans_local.pop('iblt_deltas', None)
+            self.db.execute('delete from iblt')
+            for row in self.db.query('select id from syncables', _assoc=False):
+                self._defer_update(row[0])
+
+    def all_ids(self):
+        """Return the IDs of all syncables in the tables."""
+        return [ row[0] for row in self.db.query('select id from syncables', _assoc=False) ]
+
+    @staticmethod
+    def empty_cells(n):
+        return [0] * n, [0] * n, [0] * n
+
+    def _load(self, first, n):
+        counts, xors, chxors = ret = self.empty_cells(n)
+        for cell, count, xor, chxor in self.db.query('select cell, count, xor, chxor from iblt where cell between ? and ?',
+                                                        first, first + n - 1, _assoc=False):
+            counts[cell - first] = count
+            xors[cell - first] = int.from_bytes(xor, 'big')
+            chxors[cell - first] = int.from_bytes(chxor, 'big')
+        return ret
+
+    def _cached(self, key, compute):
+        """Return `compute()`, reusing the result until the table changes (see DbCache).
+
+        Concurrent mdsync sessions sharing a connection thus load and fold the
+        tables only once."""
+        if self._cache.is_stale():
+            self._cached_values = {}
+            self._cache.loaded()
+        if key not in self._cached_values:
+            self._cached_values[key] = compute()
+        return self._cached_values[key]
+
+    def load_main(self, bits=MAIN_BITS):
+        """Load the main IBLT folded to subtables of 2**bits cells.
+
+        The returned cells are shared by all callers, do not modify them."""
+        if bits == self.MAIN_BITS:
+            return self._cached('main', lambda: self._load(0, self.STRATA_BASE))
+        return self._cached(('main', bits), lambda: self.fold(self.load_main(), bits))
+
+    def load_strata(self):
+        """Load the strata estimator. The returned cells are shared, do not modify them."""
+        return self._cached('strata', lambda: self._load(self.STRATA_BASE, self.STRATA_CELLS))
+
+    def fold(self, cells, bits):
+        """Fold main IBLT `cells` to subtables of 2**bits cells."""
+        if bits == self.MAIN_BITS: return cells
+        size = 1 << bits
+        counts, xors, chxors = ret = self.empty_cells(self.HASHES * size)
+        for i in range(self.HASHES):
+            base = i << self.MAIN_BITS
+            for c in range(1 << self.MAIN_BITS):
+                t = i * size + (c & (size - 1))
+                counts[t] += cells[0][base + c]
+                xors[t] ^= cells[1][base + c]
+                chxors[t] ^= cells[2][base + c]
+        return ret
+
+    @staticmethod
+    def subtract(a, b):
+        """Return the cells of the IBLT of the difference of sets `a` and `b`."""
+        return ([ x - y for x, y in zip(a[0], b[0]) ],
+                [ x ^ y for x, y in zip(a[1], b[1]) ],
+                [ x ^ y for x, y in zip(a[2], b[2]) ])
+
+    def decode(self, cells, bits):
+        """Decode a difference IBLT with subtables of 2**bits cells by peeling.
+
+        Modifies `cells`. Return a tuple (success, IDs only in first set, IDs
+        only in second set). On failure, the lists contain what was decoded
+        before getting stuck."""
+        counts, xors, chxors = cells
+        ours, theirs = [], []
+        def pure(c):
+            return counts[c] in (1, -1) and self.hash_chk(xors[c].to_bytes(self.ID_BYTES, 'big')) == chxors[c]
+        queue = [ c for c in range(len(counts)) if pure(c) ]
+        while queue:
+            c = queue.pop()
+            if not pure(c): continue
+            sign = counts[c]
+            id_int = xors[c]
+            id = id_int.to_bytes(self.ID_BYTES, 'big')
+            cells_of = self.cells_of(self.hash_indices(id)[0], bits)
+            # A cell can look pure by accident (with probability 2**-64)
+            if c not in cells_of: return False, ours, theirs
+            (ours if sign > 0 else theirs).append(id)
+            chk = chxors[c]
+            for t in cells_of:
+                counts[t] -= sign
+                xors[t] ^= id_int
+                chxors[t] ^= chk
+                if pure(t): queue.append(t)
+        success = not any(counts) and not any(xors) and not any(chxors)
+        return success, ours, theirs
+
+    def estimate_difference(self, strata):
+        """Estimate the size of a set difference from the difference of two strata estimators.
+
+        Return a tuple (estimate, IDs only in first set). If all strata can be
+        decoded, the estimate is exact and so is the list of IDs, otherwise
+        the list is None."""
+        per_stratum = self.HASHES << self.STRATUM_BITS
+        count = 0
+        all_ours = []
+        for i in reversed(range(self.STRATA)):
+            cells = tuple( l[i*per_stratum:(i+1)*per_stratum] for l in strata )
+            success, ours, theirs = self.decode(cells, self.STRATUM_BITS)
+            if not success:
+                # Stratum i contains about 2**-(i+1) of all IDs
+                return (count + 1) << (i + 1), None
+            count += len(ours) + len(theirs)
+            all_ours += ours
+        return count, all_ours
+
+    def bits_for(self, difference):
+        """Return the smallest subtable size (in bits) expected to decode a given difference."""
+        # With 3 hashes, peeling succeeds with high probability if there are
+        # at least 1.23 cells per element. Small tables need more headroom.
+        want = 2 * difference + 8
+        bits = 0
+        while bits < self.MAIN_BITS and self.HASHES << bits < want:
+            bits += 1
+        return bits
+
+
+class ScopedIBLT(SyncIBLT):
+    """Read-only IBLTs of the syncables in `temp.scope_syncables` (see `Store.stage_scope`),
+    computed at once and kept in memory only. The counterpart of `ScopedSyncTree`."""
+    def __init__(self, iblt):
+        super().__init__(iblt.db)
+        self.ids = { row[0] for row in self.db.query('select s.id from temp.scope_syncables x'
+                                                     ' join syncables s on s.insert_order=x.insert_order', _assoc=False) }
+        self.cells = {}
+        for id in self.ids:
+            self.add_to_cells(self.cells, id)
+
+    def has(self, id):
+        return id in self.ids
+
+    def all_ids(self):
+        return list(self.ids)
+
+    def _load(self, first, n):
+        counts, xors, chxors = ret = self.empty_cells(n)
+        for cell in range(first, first + n):
+            if cell in self.cells:
+                counts[cell - first], xors[cell - first], chxors[cell - first] = self.cells[cell]
+        return ret
+
 
 def lazy(init_func):
     from functools import wraps
@@ -221,11 +856,58 @@ class InodeInfo:
         args = ', '.join( '%s=%r'%(attr, attrval(attr)) for attr in attrs if getattr(self, attr, None) )
         return 'InodeInfo(%s)' % args
 
+class InodeIndex(DbCache):
+    """An in-memory index of the `inodes` table by inode number.
+
+    Only the columns needed to resolve directory entries are kept, as one tuple
+    per inode, so that a scan can find known inodes without querying SQLite.
+
+    The owning Store applies the changes it makes (see DbCache and
+    `Store.update_inode`)."""
+    COLUMNS = ('ino', 'iid', 'handle_type', 'handle', 'type', 'btime', 'fob', 'flv', 'fcv')
+
+    def __init__(self, db):
+        super().__init__(db)
+        self.rows = {}
+
+    def load(self):
+        self.rows = { row[0]: row for row in self.db.query('select %s from inodes' % ', '.join(self.COLUMNS), _assoc=False) }
+        self.loaded()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, ino):
+        """Return the row of inode `ino` (with only the indexed columns) or None."""
+        row = self.rows.get(ino)
+        if row is None: return None
+        return AttrDict(zip(self.COLUMNS, row))
+
+    def put(self, row):
+        """Add or replace an inode from a row with (at least) the indexed columns."""
+        self.rows[row['ino']] = tuple( row[col] for col in self.COLUMNS )
+        self.changed()
+
+    def update(self, ino, cols):
+        """Update indexed columns of inode `ino` from a dict of columns (others are ignored)."""
+        row = self.rows.get(ino)
+        if row is None: return
+        self.rows[ino] = tuple( cols.get(col, val) for col, val in zip(self.COLUMNS, row) )
+        self.changed()
+
+    def discard(self, ino):
+        self.rows.pop(ino, None)
+        self.changed()
+
 class Store:
     root_fd = None
     meta_fd = None
     SQLITE_CACHE_MB = 512
     TYPE2TABLE = {'fob': 'fobs', 'fcv': 'fcvs', 'flv': 'flvs'}
+    # Kinds in the order in which they can reference each other
+    KIND_ORDER = ('fob', 'flv', 'fcv')
+    # Maximum number of IDs queried at once
+    IDS_CHUNK = 500
     # Files whose dara is not currently stored in this store are represented by symlinks
     # with a fake nonexistent target. We call these links *placeholders*.
     PLACEHOLDER_TARGET = '/!/filoco-missing'
@@ -249,50 +931,92 @@ class Store:
         self.root_mnt = name_to_handle_at(self.root_fd, "", AT_EMPTY_PATH)[1]
         self.meta_path = self.root_path / META_DIR
         self.meta_fd = FD.open(META_DIR, os.O_DIRECTORY, dir_fd=self.root_fd)
+        # Held as long as the store is open, store-wide changes of the
+        # configuration below need it exclusively (see `set_synctree_bits`)
+        fcntl.flock(int(self.meta_fd), fcntl.LOCK_SH)
         self.store_id = slurp(self.meta_path / 'store_id')
         self.sync_mode = slurp(self.meta_path / 'sync_mode')
+        try: self.synctree_bits = int(slurp(self.meta_path / 'synctree_bits'))
+        except FileNotFoundError: self.synctree_bits = None
+        # Subtrees of the world this store wants (see `stage_scope`), None for all
+        try: self.scope = parse_scope(slurp(self.meta_path / 'scope'))
+        except FileNotFoundError: self.scope = None
         root_stat = os.fstat(self.root_fd)
         self.owner = (root_stat.st_uid, root_stat.st_gid)
         self.open_db()
         if self.sync_mode == 'synctree':
-            self.synctree = SyncTree(self.db)
+            self.synctree = SyncTree(self.db, self.synctree_bits)
             #self.synctree.create_trigger()
+        elif self.sync_mode == 'iblt':
+            self.iblt = SyncIBLT(self.db)
         self.store_id_cache = {}
         self.store_idx_cache = {}
+        self.inode_index = None
 
     #@lazy
     #def db(self):
     #    return self.open_db()
 
+    def enable_inode_index(self):
+        """Keep an in-memory index of inodes (see InodeIndex), used by `find_inode`."""
+        if self.inode_index is None:
+            self.inode_index = InodeIndex(self.db)
+            self.inode_index.load()
+
+    def reload_inode_index(self):
+        if self.inode_index is not None:
+            self.inode_index.load()
+
     def create_inode(self, info, *, iid=None, **kw):
         if iid is None: iid = gen_uuid()
         fd = info.get_fd() # keep inode alive
         st = info.get_stat()
         handle = info.get_handle()
         ftype = info.get_type()
-        # We can insert safely without any locking. Because we hold an open FD to
-        # the inode, it cannot just disappear and thus we are writing correct data.
-        self.db.insert('inodes', ino=st.st_ino, handle_type=handle[0], handle=handle[1], iid=iid, type=ftype,
+        row = AttrDict(ino=st.st_ino, handle_type=handle[0], handle=handle[1], iid=iid, type=ftype,
+                        scan_state=(SCAN_NEVER_SCANNED if ftype=='d' else SCAN_UP_TO_DATE),
                         size=st.st_size, mtime=st.st_mtime,
                         btime=st.st_mtime, # btime currently not available b/c of missing statx userspace wrapper
-                        scan_state=(SCAN_NEVER_SCANNED if ftype=='d' else SCAN_UP_TO_DATE), **kw)
+                        fob=None, flv=None, fcv=None)
+        row.update(kw)
+        with self.db.ensure_transaction():
+            # We can insert safely without any locking. Because we hold an open FD to
+            # the inode, it cannot just disappear and thus we are writing correct data.
+            self.db.insert('inodes', **row)
+            if self.inode_index is not None:
+                self.inode_index.put(row)
         #self.db.insert('fslog', event=EVENT_CREATE, iid=iid)
-        ret = self.db.query_first('select * from inodes where ino=?', st.st_ino)
-        info.iid = ret['iid']
-        return ret
+        info.iid = iid
+        return row
+
+    def update_inode(self, ino, **cols):
+        """Update columns of an inode record, keeping the inode index up to date."""
+        with self.db.ensure_transaction():
+            self.db.update('inodes', 'ino=?', ino, **cols)
+            if self.inode_index is not None:
+                self.inode_index.update(ino, cols)
 
     def find_inode(self, info):
         handle = info.get_handle()
         ino = info.get_ino()
         with self.db.ensure_transaction():
-            obj = self.db.query_first('select * from inodes where ino=?', ino)
+            if self.inode_index is not None:
+                if self.inode_index.is_stale():
+                    log.debug("Inodes changed by another connection or a rollback, reloading index")
+                    self.inode_index.load()
+                obj = self.inode_index.get(ino)
+            else:
+                obj = self.db.query_first('select * from inodes where ino=?', ino)
             if obj is not None:
                 obj_handle = FileHandle(obj.handle_type, obj.handle)
-                if obj_handle == handle or self.store.handle_exists(obj_handle):
+                if obj_handle == handle or self.handle_exists(obj_handle):
                     info.iid = obj['iid']
                     return obj
                 else:
-                    self.do_delete_inode(obj.iid)
+                    # The inode number was reused by a new inode
+                    self.db.execute('delete from inodes where ino=?', ino)
+                    if self.inode_index is not None:
+                        self.inode_index.discard(ino)
             else:
                 return None
 
@@ -381,6 +1105,8 @@ class Store:
 
             if self.sync_mode == 'synctree':
                 self.synctree.add(id, kind, origin_idx=origin_idx, created=created)
+            elif self.sync_mode == 'iblt':
+                self.iblt.add(id, kind, origin_idx=origin_idx, created=created)
             else:
                 if serial is None:
                     assert origin is None
@@ -397,16 +1123,174 @@ class Store:
             self.db.insert(self.TYPE2TABLE[kind], id=id, **data)
             return id
 
+    def existing_ids(self, ids):
+        """Return the set of those `ids` that are already present in `syncables`."""
+        ret = set()
+        for i in range(0, len(ids), self.IDS_CHUNK):
+            chunk = ids[i:i + self.IDS_CHUNK]
+            ret.update( row[0] for row in self.db.query('select id from syncables where id in (%s)'
+                                                            % ','.join(repeat('?', len(chunk))), *chunk, _assoc=False) )
+        return ret
+
+    def add_syncables(self, objs):
+        """Add many syncables received from another store at once.
+
+        `objs` is a sequence of dicts with keys id, kind, origin, data and
+        (in serial sync mode) serial. Objects already present are skipped.
+        Syncables are inserted in the given order, kind tables are then filled
+        with one `executemany` per kind and set of columns. Return the list of
+        added objects."""
+        with self.db.bulk_transaction():
+            existing = self.existing_ids([ obj['id'] for obj in objs ])
+            new = []
+            for obj in objs:
+                if obj['id'] in existing: continue
+                existing.add(obj['id'])
+                new.append(obj)
+            if not new: return new
+            now = time.time()
+            rows = [ dict(id=obj['id'], kind=obj['kind'], origin_idx=self.get_store_idx(obj['origin']),
+                          serial=obj.get('serial'), created=obj.get('created', now)) for obj in new ]
+            if self.sync_mode == 'synctree':
+                self.synctree.add_many(rows)
+            elif self.sync_mode == 'iblt':
+                self.iblt.add_many(rows)
+            else:
+                self.db.executemany('insert into syncables (id, kind, origin_idx, serial, created) values (?, ?, ?, ?, ?)',
+                        ( (row['id'], row['kind'], row['origin_idx'], row['serial'], row['created']) for row in rows ))
+            by_columns = OrderedDict()
+            for obj in new:
+                cols = tuple(sorted(obj['data']))
+                by_columns.setdefault((obj['kind'], cols), []).append(obj)
+            for kind in self.KIND_ORDER:
+                for (obj_kind, cols), group in by_columns.items():
+                    if obj_kind != kind: continue
+                    self.db.executemany('insert into %s (id, %s) values (?%s)'
+                                            % (self.TYPE2TABLE[kind], ','.join(cols), ',?' * len(cols)),
+                                        ( [obj['id']] + [ obj['data'][col] for col in cols ] for obj in group ))
+            return new
+
+    def stage_scope(self, scope):
+        """Select the syncables within `scope` into the temporary table `scope_syncables` (see `select_scope`)."""
+        select_scope(self.db, scope)
+
+    def copy_from(self, other, scope=None):
+        """Copy all syncables the store `other` has and we do not, directly between the databases.
+
+        This is what mdsync does for two stores on one host, but without any
+        encoding: the other database is attached and the missing syncables and
+        their kind rows are copied with a few set-based statements, with origins
+        mapped to our store indices. As in mdsync, parents of new versions lose
+        the head flag and the FOBs are stamped as having new versions. Both
+        stores must use the same sync mode. If `scope` is given, only syncables
+        within it are copied. Return the number of copied syncables."""
+        if scope is not None:
+            with other.db:
+                other.stage_scope(scope)
+                orders = list(other.db.query('select insert_order from temp.scope_syncables', _assoc=False))
+        self.db.execute('attach database ? as peer', '/proc/self/fd/%d/meta.sqlite' % other.meta_fd)
+        try:
+            with self.db.bulk_transaction():
+                if scope is not None:
+                    self.db.execute('drop table if exists temp.copy_scope')
+                    self.db.execute('create temp table copy_scope (insert_order integer primary key)')
+                    self.db.executemany('insert into temp.copy_scope values (?)', orders)
+                return self._copy_from_peer(scope is not None)
+        finally:
+            self.db.execute('detach database peer')
+
+    def _copy_from_peer(self, scoped):
+        db = self.db
+        db.execute('insert or ignore into stores (id) select id from peer.stores')
+        db.execute('drop table if exists temp.copy_new')
+        db.execute('create temp table copy_new (peer_order integer primary key, id blob not null)')
+        db.execute('insert into temp.copy_new select p.insert_order, p.id from peer.syncables p'
+                   ' where not exists (select 1 from main.syncables s where s.id=p.id)'
+                   + (' and p.insert_order in (select insert_order from temp.copy_scope)' if scoped else ''))
+        ids = [ row[0] for row in db.query('select id from temp.copy_new order by peer_order', _assoc=False) ]
+        if not ids: return 0
+        # Like received syncables, copied ones are created now from our point of view
+        cols, values = ['id', 'kind', 'origin_idx', 'created'], ['p.id', 'p.kind', 'o.idx', ':now']
+        if self.sync_mode == 'serial':
+            cols.append('serial'); values.append('p.serial')
+        elif self.sync_mode == 'synctree':
+            self.synctree.register_functions()
+            cols.append('tree_key'); values.append('synctree_pos(p.id)')
+        now = time.time()
+        db.execute('insert into syncables ({cols}) select {values} from temp.copy_new n'
+                   ' join peer.syncables p on p.insert_order=n.peer_order'
+                   ' join peer.stores ps on ps.idx=p.origin_idx join main.stores o on o.id=ps.id'
+                   ' order by n.peer_order'.format(cols=', '.join(cols), values=', '.join(values)), now=now)
+        if self.sync_mode == 'synctree':
+            self.synctree.added(ids)
+        elif self.sync_mode == 'iblt':
+            self.iblt.added(ids)
+        for kind in self.KIND_ORDER:
+            table = self.TYPE2TABLE[kind]
+            peer_cols = { row.name for row in db.query('pragma peer.table_info(%s)' % table) }
+            # Underscored columns are internal, like in mdsync
+            cols = [ row.name for row in db.query('pragma main.table_info(%s)' % table)
+                        if not row.name.startswith('_') and row.name in peer_cols ]
+            db.execute('insert into main.{tbl} ({cols}) select {pcols} from temp.copy_new n'
+                       ' join peer.{tbl} p on p.id=n.id order by n.peer_order'
+                       .format(tbl=table, cols=', '.join(cols), pcols=', '.join( 'p.' + col for col in cols )))
+        for kind in ('flv', 'fcv'):
+            table = self.TYPE2TABLE[kind]
+            # Split the concatenated parent_vers of the new versions with a recursive query
+            db.execute('update {tbl} set _is_head=0 where id in (with recursive parents(id, rest) as'
+                       ' (select null, v.parent_vers from temp.copy_new n join {tbl} v on v.id=n.id'
+                       '  union all select substr(rest, 1, {n}), substr(rest, {n} + 1) from parents where length(rest) > 0)'
+                       ' select id from parents where id is not null)'.format(tbl=table, n=ID_BYTES))
+            db.execute('update fobs set _new_{kind}s=? where id in'
+                       ' (select v.fob from temp.copy_new n join {tbl} v on v.id=n.id)'.format(kind=kind, tbl=table), now)
+        db.execute('drop table temp.copy_new')
+        return len(ids)
+
     def open_db(self):
         self.db = SqliteWrapper('/proc/self/fd/%d/meta.sqlite' % self.meta_fd, wal=True)
         # TODO set those only for large scans and not live updates?
         self.db.execute('PRAGMA wal_autocheckpoint=20000')
         # https://www.sqlite.org/pragma.html#pragma_cache_size
         self.db.execute('PRAGMA cache_size=%d' % (- self.SQLITE_CACHE_MB*1024))
-        if self.sync_mode == 'synctree':
+        if self.sync_mode in ('synctree', 'iblt'):
             self.db.connection.enableloadextension(True)
             self.db.connection.loadextension(str(FILOCO_LIBDIR / 'binxor.so'))
 
+    def set_synctree_bits(self, bits):
+        """Change the arity of the synctree to `2**bits` and rebuild it.
+
+        All stores in a world must use the same arity. Other processes read
+        it only when opening the store, so this raises StoreInUse if anyone
+        else has the store open. The `synctree_bits` file is replaced inside
+        the rebuild transaction, just before the commit. If a crash comes in
+        between, the tree does not match the file, run this again."""
+        if self.sync_mode != 'synctree':
+            raise ValueError("Store does not use synctree sync mode")
+        try:
+            fcntl.flock(int(self.meta_fd), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # A failed conversion may have dropped our shared lock
+            fcntl.flock(int(self.meta_fd), fcntl.LOCK_SH)
+            raise StoreInUse(self.root_path)
+        try:
+            synctree = SyncTree(self.db, bits)
+            bits_path = self.meta_path / 'synctree_bits'
+            try:
+                with self.db:
+                    synctree.rebuild()
+                    spurt(bits_path, str(bits))
+            except BaseException:
+                if self.synctree_bits is None:
+                    try: bits_path.unlink()
+                    except FileNotFoundError: pass
+                else:
+                    spurt(bits_path, str(self.synctree_bits))
+                raise
+            self.synctree_bits = bits
+            self.synctree = synctree
+        finally:
+            fcntl.flock(int(self.meta_fd), fcntl.LOCK_SH)
+
     def open_handle(self, handle, flags):
         return FD(open_by_handle_at(self.root_fd, handle, flags))
 
@@ -457,7 +1341,11 @@ class Store:
 
     def delete_inode(self, info):
         log.debug('Deleting inode %r from database', info)
-        self.db.execute('delete from inodes where iid=?', info.iid)
+        with self.db.ensure_transaction():
+            self.db.execute('delete from inodes where iid=?', info.iid)
+            if self.inode_index is not None:
+                if info.ino: self.inode_index.discard(info.ino)
+                else: self.inode_index.invalidate()
 
 
     def get_store_idx(self, id):
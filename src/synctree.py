@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+"""Maintenance of the synctree (the XOR tree used by `synctree` sync mode)."""
+
+from utils import *
+from store import *
+
+import logging
+log = logging.getLogger('filoco.synctree')
+
+def open_store(store):
+    st, sub = Store.find(store)
+    if sub != Path(): raise ArgumentError("Synctree operations must be done on whole store (%s), not a subtree." % st.root_path)
+    if st.sync_mode != 'synctree': raise ArgumentError("Store %s does not use synctree sync mode." % st.root_path)
+    return st
+
+def rebuild(store):
+    """Recompute the whole synctree from the list of syncables.
+
+    Useful after crashes or large imports.
+
+    :param store: the store path
+    """
+    st = open_store(store)
+    log.info("Rebuilding synctree of %s", st.root_path)
+    st.synctree.rebuild()
+
+def verify(store):
+    """Check the synctree against the list of syncables and report mismatched positions.
+
+    Nothing is modified. Exits with status 1 if there are mismatches.
+
+    :param store: the store path
+    """
+    st = open_store(store)
+    bad_keys, bad_pos = st.synctree.verify()
+    for pos in bad_pos:
+        print("Mismatched position %d (level %d)" % (pos, st.synctree.level_of(pos)))
+    if bad_keys:
+        print("%d syncables have a wrong tree key" % bad_keys)
+    if bad_keys or bad_pos:
+        err("Synctree is inconsistent, run `synctree.py rebuild`.")
+    else:
+        log.info("Synctree OK")
+
+def set_bits(store, bits:int):
+    """Change synctree arity to 2**bits and rebuild the synctree.
+
+    All stores in a world must use the same arity, otherwise they refuse to sync.
+
+    :param store: the store path
+    :param bits: number of position bits per tree level (must divide 48)
+
+    Nothing else may use the store meanwhile.
+    """
+    st = open_store(store)
+    log.info("Rebuilding synctree of %s with %d bits per level", st.root_path, bits)
+    try:
+        st.set_synctree_bits(bits)
+    except StoreInUse as e:
+        err("%s Stop all syncs, scans and other tools using it first." % e)
+
+if __name__ == '__main__':
+    run(rebuild, verify, set_bits)
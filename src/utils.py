@@ -93,7 +93,8 @@ class SqliteWrapper(object):
         # XXX This waits using a (quite tight) busy loop (WTF?). Will probably
         # have to replace it with some sane custom locking.
         self.connection.setbusytimeout(int(timeout*1000))
-        self._dummy_created = False
+        self._trans_depth = 0
+        self.trans_local = None
 
     def _iter(self, cur, assoc=True):
         col_names = None
@@ -177,18 +178,71 @@ class SqliteWrapper(object):
             # Starting new transaction, initialize transaction-local variables
             self.trans_local = AttrDict()
         self.connection.__enter__()
+        self._trans_depth += 1
         return self
 
     def __exit__(self, tp, val, tb):
+        self._trans_depth -= 1
+        if tp is None and self._trans_depth == 0:
+            try:
+                self._run_before_commit()
+            except BaseException:
+                self.connection.__exit__(*sys.exc_info())
+                self.trans_local = None
+                raise
+        trans_local = self.trans_local
         self.connection.__exit__(tp, val, tb)
         if self.connection.getautocommit():
             self.trans_local = None
+            if tp is None and trans_local:
+                for func in trans_local.get('after_commit', {}).values(): func()
 
     def ensure_transaction(self):
         """Wrap in a transaction if one is not already active but do not create a nested transaction"""
         if self.connection.getautocommit(): return self
         else: return null_contextmanager()
 
+    @contextlib.contextmanager
+    def bulk_transaction(self):
+        """Like `ensure_transaction`, but mark the transaction as a bulk one.
+
+        Code running inside a bulk transaction may defer expensive bookkeeping
+        (e.g. synctree updates) in memory and apply it once using `before_commit`."""
+        with self.ensure_transaction():
+            self.trans_local.bulk = True
+            yield self
+
+    def before_commit(self, key, func):
+        """Call `func` right before the current transaction commits.
+
+        Registering another function under the same `key` within one transaction
+        is a no-op. Nothing is called if the transaction is rolled back."""
+        hooks = self.trans_local.get('before_commit')
+        if hooks is None:
+            hooks = self.trans_local.before_commit = OrderedDict()
+        hooks.setdefault(key, func)
+
+    def after_commit(self, key, func):
+        """Call `func` after the current transaction successfully commits.
+
+        Same rules as for `before_commit` apply. Use this to keep in-memory
+        caches in sync with the database."""
+        hooks = self.trans_local.get('after_commit')
+        if hooks is None:
+            hooks = self.trans_local.after_commit = OrderedDict()
+        hooks.setdefault(key, func)
+
+    def data_version(self):
+        """Return a number that changes whenever another connection commits to the database."""
+        return self.query_first('pragma data_version', _assoc=False)[0]
+
+    def _run_before_commit(self):
+        hooks = self.trans_local.get('before_commit')
+        # Hooks may write to the database and register further hooks.
+        while hooks:
+            key, func = hooks.popitem(last=False)
+            func()
+
     def lock_now(self):
         """Acquire a RESERVED lock (like BEGIN IMMEDIATE), preventing concurrent writes from other connections.
 
@@ -199,11 +253,17 @@ class SqliteWrapper(object):
 
         This is neccessary to support an atomic read-modify-write, for example."""
 
-        # A dummy SQL update that does nothing
-        if not self._dummy_created:
-            self.execute("create table if not exists lock_dummy (dummy)")
+        # A dummy SQL update that does nothing. It must be the first statement
+        # (the table is usually there already): in WAL mode, a transaction that
+        # has read something fails immediately instead of waiting for the lock
+        # if another connection commits in the meantime.
+        import apsw
         if not self.trans_local.get('locked'):
-            self.execute("update lock_dummy set dummy=1 where 0=0")
+            try:
+                self.execute("update lock_dummy set dummy=1 where 0=0")
+            except apsw.SQLError:
+                self.execute("create table if not exists lock_dummy (dummy)")
+                self.execute("update lock_dummy set dummy=1 where 0=0")
             self.trans_local.locked = True
 
     def clear_cache(self):
@@ -211,6 +271,51 @@ class SqliteWrapper(object):
         self.execute('pragma cache_size = -1') # temporarily limit to one kilobyte
         self.execute('pragma cache_size = %d' % csize)
 
+class DbCache:
+    """Base for in-memory copies of database contents kept by one connection.
+
+    SQLite remains the durable copy. A cache matches the database as of the
+    `data_version` it was loaded at, so commits of other connections make it
+    stale. Changes made through our own connection do not change `data_version`,
+    the owner has to apply them to the cache and call `changed`, or call
+    `invalidate`. A cache loaded or changed within a transaction may hold
+    uncommitted data, so it is `dirty` until the transaction commits, and
+    stale if it is rolled back."""
+    def __init__(self, db):
+        self.db = db
+        self.data_version = None
+        self.dirty = False
+
+    def is_stale(self):
+        """Whether the cache has to be reloaded before use. Within a transaction,
+        this is only checked until the answer is no (or until `invalidate`)."""
+        trans_local = self.db.trans_local
+        fresh = None if trans_local is None else trans_local.setdefault('fresh_caches', set())
+        if fresh is not None and id(self) in fresh: return False
+        if self.data_version is None or self.dirty or self.data_version != self.db.data_version():
+            return True
+        if fresh is not None: fresh.add(id(self))
+        return False
+
+    def loaded(self):
+        """Record that the cache was just loaded from the database."""
+        self.data_version = self.db.data_version()
+        self.dirty = False
+        if self.db.trans_local is not None:
+            self.changed()
+            self.db.trans_local.setdefault('fresh_caches', set()).add(id(self))
+
+    def changed(self):
+        """Record a change of the cache made along with an uncommitted change of the database."""
+        self.dirty = True
+        self.db.after_commit(('db_cache', id(self)), partial(setattr, self, 'dirty', False))
+
+    def invalidate(self):
+        """Make the cache stale, e.g. after changing the database in a way it cannot follow."""
+        self.data_version = None
+        if self.db.trans_local is not None:
+            self.db.trans_local.get('fresh_caches', set()).discard(id(self))
+
 def fdscandir(fd):
     """Read the contents of a directory identified by file descriptor `fd`."""
     return os.scandir("/proc/self/fd/%d" % fd)
@@ -414,22 +519,141 @@ async def aio_write_pipe(file):
 
 import struct
 import cbor
+
+class ProtocolError(Exception):
+    """The remote side does not speak our protocol or is incompatible with us."""
+    pass
+
+import zlib, lzma
+
+class Codec:
+    """A stream compression method that can be negotiated by `Protocol`."""
+    def __init__(self, name, compressor, decompressor, flush, reset_after_flush=False):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        # Return whatever the compressor holds so that the data written so far
+        # can be decompressed.
+        self.flush = flush
+        # Whether `flush` ends the compressed stream. The data after it then
+        # form a new stream, with a new compressor and decompressor.
+        self.reset_after_flush = reset_after_flush
+
+# lzma cannot flush without ending the stream. We use raw LZMA2 streams, as
+# the headers and index of the .xz container would add some 60 bytes to every
+# exchange.
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+# In order of preference. zlib is cheap on CPU, lzma compresses better.
+CODECS = OrderedDict([
+    ('zlib', Codec('zlib', zlib.compressobj, zlib.decompressobj, lambda c: c.flush(zlib.Z_SYNC_FLUSH))),
+    ('lzma', Codec('lzma', lambda: lzma.LZMACompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+                   lambda: lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS),
+                   lambda c: c.flush(), reset_after_flush=True)),
+])
+
+class CompressedWriter:
+    """Wrap an asyncio.StreamWriter, compressing everything written.
+
+    Written data are buffered by the compressor until `drain` (or `flush`),
+    so that many small messages compress well together."""
+    def __init__(self, writer, codec):
+        self.writer = writer
+        self.transport = writer.transport
+        self.codec = codec
+        self.compressor = codec.compressor()
+        self.pending = False
+
+    def write(self, data):
+        if not data: return
+        self.pending = True
+        out = self.compressor.compress(data)
+        if out: self.writer.write(out)
+
+    def flush(self):
+        if not self.pending: return
+        self.writer.write(self.codec.flush(self.compressor))
+        if self.codec.reset_after_flush:
+            self.compressor = self.codec.compressor()
+        self.pending = False
+
+    async def drain(self):
+        self.flush()
+        await self.writer.drain()
+
+    def write_eof(self):
+        self.flush()
+        self.writer.write_eof()
+
+class DecompressingReader:
+    """Wrap an asyncio.StreamReader, decompressing everything read."""
+    READ_SIZE = 1 << 16
+    def __init__(self, reader, codec):
+        self.reader = reader
+        self.codec = codec
+        self.decompressor = codec.decompressor()
+        self.buf = bytearray()
+
+    def _feed(self, data):
+        while data:
+            self.buf += self.decompressor.decompress(data)
+            if self.codec.reset_after_flush and self.decompressor.eof:
+                # End of one stream, another may follow
+                data = self.decompressor.unused_data
+                self.decompressor = self.codec.decompressor()
+            else:
+                data = b''
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            data = await self.reader.read(self.READ_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self.buf), n)
+            self._feed(data)
+        ret = bytes(self.buf[:n])
+        del self.buf[:n]
+        return ret
+
 class Protocol:
     SIZE_FMT = '>L'
     SIZE_BYTES = struct.calcsize(SIZE_FMT)
     xchg_timeout = 10
-
-    def __init__(self, file):
+    # Bulk senders wait for the other side only when more than this is buffered
+    WRITE_HIGH_WATER = 1 << 20
+
+    def __init__(self, file, compress=None, initiator=False):
+        """
+        :param compress: names of codecs (see CODECS) we are willing to use, in order
+            of preference, all by default
+        :param initiator: whether we opened the connection, see `process_hello`
+        """
         if isinstance(file, tuple):
             self.in_file, self.out_file = file
         else:
             self.in_file = self.out_file = file
         self.did_hello = False
+        self.remote_hello = None
+        self.local_hello = None
+        if compress is None: compress = list(CODECS)
+        for name in compress:
+            if name not in CODECS: raise ValueError("Unknown compression method %r" % name)
+        self.compress = list(compress)
+        self.initiator = initiator
+        self.codec = None
 
     def send_sized(self, data):
         self.out_stream.write(struct.pack(self.SIZE_FMT, len(data)))
         self.out_stream.write(data)
 
+    def send_sized_many(self, items):
+        """Send several messages (as if by `send_sized`) with one write."""
+        self.out_stream.write(b''.join( struct.pack(self.SIZE_FMT, len(data)) + data for data in items ))
+
+    async def drain_if_needed(self):
+        """Wait until the transport sends buffered data if there is more than WRITE_HIGH_WATER of it."""
+        if self.out_stream.transport.get_write_buffer_size() > self.WRITE_HIGH_WATER:
+            await self.out_stream.drain()
+
     def send_cbor(self, obj):
         # XXX we prefix each CBOR object with a size because the `cbor' module
         # does not support incremental (push) decoding and we would not know
@@ -472,10 +696,16 @@ class Protocol:
     async def recv(self, what):
         return await self._dispatch('recv_', what)
 
+    def get_hello(self):
+        """Return a dictionary describing our end of the connection. Sent
+        to the other side together with the first exchange."""
+        return {'compress': self.compress, 'initiator': self.initiator}
+
     def send_hello(self):
-        pass
+        self.local_hello = self.get_hello()
+        self.send_cbor(self.local_hello)
     async def recv_hello(self):
-        pass
+        return await self.recv_cbor()
 
     async def exchange(self, send_objects, to_recv):
         if not self.did_hello:
@@ -500,7 +730,30 @@ class Protocol:
         return ret
 
     def process_hello(self, remote_hello):
-        pass
+        """Check the remote hello. Raise a ProtocolError if we cannot talk to the other side."""
+        self.remote_hello = remote_hello
+        self.did_hello = True
+        # Both sides pick the same codec, the first one allowed by both in the
+        # order of the side which opened the connection. If both or neither
+        # claim to be that side, in the order of CODECS. The hello is sent
+        # together with the first exchange, which is complete by now, so all
+        # further data in both directions is compressed.
+        remote_compress = remote_hello.get('compress', [])
+        remote_initiator = remote_hello.get('initiator', False)
+        if self.initiator and not remote_initiator:
+            order = self.compress
+        elif remote_initiator and not self.initiator:
+            order = remote_compress
+        else:
+            order = list(CODECS)
+        for name in order:
+            if name in self.compress and name in remote_compress:
+                codec = CODECS[name]
+                logging.debug('Using %s compression', name)
+                self.codec = codec
+                self.in_stream = DecompressingReader(self.in_stream, codec)
+                self.out_stream = CompressedWriter(self.out_stream, codec)
+                break
 
     async def shutdown(self):
         # Workaround for asyncio bug where all data is not flushed before closing socket